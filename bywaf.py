@@ -11,16 +11,17 @@ import readline
 import argparse
 from cmd import Cmd
 import sys
-import string
 import concurrent.futures
 import imp # for loading other modules
 import os.path
 import os
+import threading
+from collections import OrderedDict
 from functools import partial
 
 
 # our library
-#from hostdb import HostDatabase
+from hostdb import HostDatabase
 
 # global constants
 DEFAULT_MAX_CONCURRENT_JOBS = 10
@@ -31,6 +32,189 @@ DEFAULT_PLUGIN_PATH = "./"
 # history file name
 DEFAULT_HISTORY_FILENAME = "bywaf-history.txt"
 
+# persistent response cache file name (kept next to the history file) and
+# time to live of its entries in seconds; a TTL of 0 disables the cache
+DEFAULT_RESPONSE_CACHE_FILENAME = "bywaf-responses.db"
+DEFAULT_RESPONSE_CACHE_TTL = "0"
+
+# host information database file name; by default the database is kept in
+# memory only (see --hostdb)
+DEFAULT_HOSTDB_FILENAME = ""
+
+# request scheduling: requests in flight overall, requests per second to a
+# single host and requests in flight to a single host (0 is unlimited)
+DEFAULT_MAX_INFLIGHT = "20"
+DEFAULT_RATE_LIMIT = "0"
+DEFAULT_MAX_INFLIGHT_PER_HOST = "0"
+
+# finished jobs kept for "jobs" and "result", and the result text they may
+# hold in memory between them (0 is unlimited); older results are written to
+# files in RESULT_SPILL_DIR, or dropped when it is empty
+DEFAULT_MAX_FINISHED_JOBS = "1000"
+DEFAULT_MAX_RESULT_BYTES = "16777216"
+DEFAULT_RESULT_SPILL_DIR = ""
+
+# Handed to every backgrounded job; "kill" cancels it, and plugins (and the
+# engines they pass it to) check cancelled() to stop early
+class CancelToken:
+
+   def __init__(self):
+       self.event = threading.Event()
+
+   def cancel(self):
+       self.event.set()
+
+   def cancelled(self):
+       return self.event.is_set()
+
+# What is kept of a backgrounded job once it has finished, in place of its
+# Futures object
+class FinishedJob:
+
+   def __init__(self, job):
+       self.job_id = job.job_id
+       self.name = job.name
+       self.command_line = job.command_line
+       self.started = not job.cancelled()
+       self.status = 'Cancelled' if job.cancelled() or job.cancel_token.cancelled() else 'Completed'
+       self.result = None
+       self.filename = None   # where the result was spilled to
+       self.encoded = False   # whether it was text encoded as UTF-8 to be spilled
+       self.dropped = False   # whether the result was dropped instead
+
+       if self.started:
+           error = job.exception()
+           if error is not None:
+               self.result = 'error: {}'.format(error)
+           elif job.result() is not None:
+               self.result = job.result()
+               if not hasattr(self.result, 'encode'):
+                   self.result = str(self.result)
+       self.size = len(self.result) if self.result is not None else 0
+
+   # move the result out of memory: to a file in spill_dir, or nowhere
+   def spill(self, spill_dir):
+       if spill_dir:
+           filename = os.path.join(spill_dir, 'bywaf-job-{}-{}.txt'.format(os.getpid(), self.job_id))
+           encoded = not isinstance(self.result, bytes)
+           data = self.result.encode('utf-8') if encoded else self.result
+           try:
+               with open(filename, 'wb') as f:
+                   f.write(data)
+               self.filename = filename
+               self.encoded = encoded
+           except (IOError, OSError) as e:
+               print('Could not spill the result of job {}: {}'.format(self.job_id, e))
+       self.dropped = self.filename is None
+       self.result = None
+
+   # the result, read back as the type it had when it was spilled
+   def result_text(self):
+       if self.filename is None:
+           return self.result
+       with open(self.filename, 'rb') as f:
+           data = f.read()
+       return data.decode('utf-8', 'replace') if self.encoded else data
+
+   # delete the spilled result, if any
+   def discard(self):
+       if self.filename is not None:
+           try:
+               os.remove(self.filename)
+           except OSError:
+               pass
+           self.filename = None
+
+# Backgrounded jobs indexed by job ID.  Running jobs are Futures objects;
+# finish() replaces them with a FinishedJob.  Only the newest max_finished
+# finished jobs are kept, and their results hold at most max_result_bytes in
+# memory between them, oldest results being spilled first (0 is unlimited
+# for both).  Jobs finish in worker threads, hence the lock.
+class JobRegistry:
+
+   def __init__(self, max_finished=DEFAULT_MAX_FINISHED_JOBS, max_result_bytes=DEFAULT_MAX_RESULT_BYTES,
+                spill_dir=DEFAULT_RESULT_SPILL_DIR):
+       self.lock = threading.RLock()
+       self.jobs = OrderedDict()      # job ID: Futures object or FinishedJob, oldest first
+       self.running = set()           # IDs of jobs not finished yet
+       self.finished = OrderedDict()  # IDs of finished jobs, in the order they finished
+       self.held = OrderedDict()      # IDs of finished jobs with their result in memory, likewise
+       self.result_bytes = 0
+       self.forgotten = 0             # finished jobs dropped to stay under max_finished
+       self.configure(max_finished, max_result_bytes, spill_dir)
+
+   def configure(self, max_finished, max_result_bytes, spill_dir):
+       max_finished, max_result_bytes = int(max_finished), int(max_result_bytes)
+       with self.lock:
+           self.max_finished = max(0, max_finished)
+           self.max_result_bytes = max(0, max_result_bytes)
+           self.spill_dir = spill_dir
+           self.trim()
+
+   def __len__(self):
+       return len(self.jobs)
+
+   def get(self, job_id):
+       return self.jobs.get(job_id)
+
+   # all jobs, oldest first
+   def values(self):
+       with self.lock:
+           return list(self.jobs.values())
+
+   def running_ids(self):
+       with self.lock:
+           return sorted(self.running)
+
+   def finished_ids(self):
+       with self.lock:
+           return list(self.finished)
+
+   def add(self, job):
+       with self.lock:
+           self.jobs[job.job_id] = job
+           self.running.add(job.job_id)
+
+   # replace a job's Futures object with a FinishedJob, and return that
+   def finish(self, job):
+       record = FinishedJob(job)
+       with self.lock:
+           if job.job_id in self.running:
+               self.running.discard(job.job_id)
+               self.jobs[job.job_id] = record
+               self.finished[job.job_id] = True
+               if record.result is not None:
+                   self.held[job.job_id] = True
+                   self.result_bytes += record.size
+               self.trim()
+       return record
+
+   # remove a finished job, returning False if it is still running
+   def remove(self, job_id):
+       with self.lock:
+           if job_id in self.running:
+               return False
+           del self.finished[job_id]
+           self.release(self.jobs.pop(job_id))
+           return True
+
+   def release(self, record):
+       if self.held.pop(record.job_id, None):
+           self.result_bytes -= record.size
+       record.discard()
+
+   # enforce the retention limits, oldest jobs first
+   def trim(self):
+       while self.max_finished and len(self.finished) > self.max_finished:
+           job_id, _ = self.finished.popitem(last=False)
+           self.release(self.jobs.pop(job_id))
+           self.forgotten += 1
+       while self.max_result_bytes and self.result_bytes > self.max_result_bytes:
+           job_id, _ = self.held.popitem(last=False)
+           record = self.jobs[job_id]
+           self.result_bytes -= record.size
+           record.spill(self.spill_dir)
+
 # Interactive shell class
 class WAFterpreter(Cmd):
     
@@ -57,8 +241,8 @@ class WAFterpreter(Cmd):
       # running counter, increments with every job; used as Job ID
       self.job_counter = 0 
       
-      # job pool (list of runnign and completed Futures objects)      
-      self.jobs = []  
+      # job pool (running Futures objects and finished jobs, by job ID)
+      self.jobs = JobRegistry()
 
       # currently-selected plugin's name and object (reference to a job in self.jobs)
       self.current_plugin = None
@@ -67,8 +251,12 @@ class WAFterpreter(Cmd):
       # list of newly-finished backgrounded plugin command jobs
       self.finished_jobs = []
 
-      # create host information database
-#      self.hostdb = HostDatabase()
+      # the CancelToken of the job running in the current thread, if any
+      self.job_local = threading.local()
+
+      # host information database, opened by open_hostdb() once the
+      # HOSTDB_FILENAME global option is known
+      self.hostdb = None
       
       
    # ----------- Overriden Methods ------------------------------------------------------
@@ -84,7 +272,8 @@ class WAFterpreter(Cmd):
        if len(self.finished_jobs) > 0:
            
            for j in self.finished_jobs:
-               print("[{}]  Done  {}".format(str(j.job_id), j.command_line))
+               status = 'Cancelled' if j.status == 'Cancelled' else 'Done'
+               print("[{}]  {}  {}".format(str(j.job_id), status, j.command_line))
                
            # clear the finished jobs list
            self.finished_jobs = []
@@ -169,17 +358,17 @@ class WAFterpreter(Cmd):
                 print('backgrounding job {}'.format(self.job_counter))
                 
                 # background the job
-                job = self.job_executor.submit(func, arg)
+                token = CancelToken()
+                job = self.job_executor.submit(self.run_job, token, func, arg)
                 
                 job.job_id = self.job_counter
                 job.name = self.current_plugin_name + '/' + cmd
                 job.command_line = line
-                job.add_done_callback(self.finished_job_callback)
-                
-                job.Canceled = False
+                job.cancel_token = token
 
-                # add job to the list of running jobs
-                self.jobs.append(job)
+                # add job to the running jobs (before it can finish)
+                self.jobs.add(job)
+                job.add_done_callback(self.finished_job_callback)
                 self.job_counter += 1
                 ret = 0 # 0 keeps WAFterpreter going, 1 quits it
 
@@ -242,6 +431,16 @@ class WAFterpreter(Cmd):
        # cancel further input delegation
        self.delegate_input_handler = None
        
+   # return an option's value, falling back to its default value.  options is
+   # a plugin's options dictionary, the current plugin's by default; plugins
+   # pass their own, as another plugin may be selected while their
+   # backgrounded commands run.
+   def get_option(self, name, options=None):
+       if options is None:
+           options = self.current_plugin.options
+       value, default_value, _required, _descr = options[name]
+       return value or default_value
+
    # set an option's value.  Called by do_set()            
    def set_option(self, name, value):
 
@@ -265,26 +464,88 @@ class WAFterpreter(Cmd):
                self.current_plugin.options[name] = value, _defaultvalue, _required, _descr
 
            
-   # return a Futures object given its job ID as a string or int
-   def get_job(self, _job_id):
-
-       job = None 
-       job_id = int(_job_id) 
+   # (re)open the host information database; an empty filename keeps it in memory
+   def open_hostdb(self, filename):
+       try:
+           hostdb = HostDatabase(filename or None)
+       except Exception as e:
+           print('Could not open host database {}: {}'.format(filename, e))
+           return
+       if self.hostdb is not None:
+           self.hostdb.close()
+       self.hostdb = hostdb
+
+   # load a library module (such as evillib or wafw00f) living next to the
+   # plugin at plugin_path, once, and return it.  evillib gets the request
+   # scheduling global options as it loads.
+   def load_library(self, name, plugin_path):
+       if name not in sys.modules:
+           library_path = os.path.join(os.path.dirname(plugin_path), name + '.py')
+           imp.load_source(name, library_path)
+           if name == 'evillib':
+               self.configure_scheduler()
+       return sys.modules[name]
+
+   # apply the MAX_INFLIGHT, RATE_LIMIT and MAX_INFLIGHT_PER_HOST global options
+   # to the request scheduler evillib shares between all engines, once a plugin
+   # has loaded evillib.  Requests of running jobs are admitted under the new
+   # limits straight away.
+   def configure_scheduler(self):
+       evillib = sys.modules.get('evillib')
+       if evillib is None:
+           return
+       try:
+           evillib.configurescheduler(self.global_options)
+       except ValueError:
+           print('MAX_INFLIGHT, RATE_LIMIT and MAX_INFLIGHT_PER_HOST must be numbers, keeping the current limits')
 
-       # build a dict of jobs indexed by job_id
-       jobs = dict(zip((j.job_id for j in self.jobs), (j for j in self.jobs)))
+   # return a Futures object (or a FinishedJob once it has finished) given
+   # its job ID as a string or int, None if there is no such job
+   def get_job(self, _job_id):
+       return self.jobs.get(int(_job_id))
 
-       # try and return the job, None if it was not there
+   # apply the job retention global options
+   def configure_jobs(self):
        try:
-           job = jobs[job_id]
-       except KeyError:
-           pass
-       
-       return job
+           self.jobs.configure(self.global_options.get('MAX_FINISHED_JOBS', DEFAULT_MAX_FINISHED_JOBS),
+                               self.global_options.get('MAX_RESULT_BYTES', DEFAULT_MAX_RESULT_BYTES),
+                               self.global_options.get('RESULT_SPILL_DIR', DEFAULT_RESULT_SPILL_DIR))
+       except ValueError:
+           print('MAX_FINISHED_JOBS and MAX_RESULT_BYTES must be numbers')
    
+   # run a backgrounded command, making its CancelToken available to it
+   # through cancel_token().  Errors of a cancelled job are what its plugin
+   # raised to stop, so they are not its result.
+   def run_job(self, token, func, arg):
+       self.job_local.token = token
+       try:
+           return func(arg)
+       except Exception:
+           if token.cancelled():
+               return 'Cancelled'
+           raise
+       finally:
+           self.job_local.token = None
+
+   # return the CancelToken of the job running in the calling thread, or None
+   # for a command running in the foreground.  Plugins pass it to their engines.
+   def cancel_token(self):
+       return getattr(self.job_local, 'token', None)
+
+   # one of Queued, Running, Cancelling, Cancelled or Completed
+   def job_status(self, job):
+       if isinstance(job, FinishedJob):
+           return job.status
+       cancelled = job.cancelled() or job.cancel_token.cancelled()
+       if job.done():
+           return 'Cancelled' if cancelled else 'Completed'
+       if cancelled:
+           return 'Cancelling'
+       return 'Running' if job.running() else 'Queued'
+
    # update list of newly-finished jobs 
    def finished_job_callback(self, finished_job):
-       self.finished_jobs.append(finished_job)
+       self.finished_jobs.append(self.jobs.finish(finished_job))
        
    # physically load a module (called from do_import)
    # implementation adapted from http://stackoverflow.com/questions/301134/dynamic-module-import-in-python   
@@ -430,20 +691,24 @@ class WAFterpreter(Cmd):
        # loop over the specified jobs...
        for job_id in job_ids:
          job = self.get_job( job_id )
-         
-         # ...and try to end them
-         try:
-             # this doesn't cancel the job, it just stops a job from starting
-#             result = job.cancel() 
-
-             job.Canceled = True
-             print("result is {}".format(result))
-         except:
+         if job is None:
              print('Job ID {} not found'.format(job_id))
+             continue
+         if isinstance(job, FinishedJob) or job.done():
+             print('Job {} has already finished'.format(job_id))
+             continue
+
+         # ...and end them: a job that has not started yet never will, a
+         # running one stops at its next request or check of its token
+         job.cancel_token.cancel()
+         if job.cancel():
+             print('Job {} cancelled'.format(job_id))
+         else:
+             print('Job {} cancelling'.format(job_id))
 
              
    def complete_kill(self,text,line,begin_idx,end_idx):
-       job_ids  = [str(j.job_id) for j in self.jobs if not j.done()]
+       job_ids  = [str(i) for i in self.jobs.running_ids()]
        opts = [x+' ' for x in job_ids if x.startswith(text)]
        return opts
 
@@ -457,24 +722,15 @@ class WAFterpreter(Cmd):
            return
 
        for job_id in job_ids:
-         # loop through jobs list looking for a job with a matching job_id ,
-         for (i,item) in enumerate(self.jobs):
-           
-             # match found, so remove it.  Fail if this job is currently running.
-             if item.job_id == job_id:
-                 if item.running():
-                     print('Job {} is still running!'.format(job_id))
-                     break
-
-                 # remove from job queue
-                 del self.jobs[i]
-                 break
-         else:
+         # remove the job with a matching job_id.  Fail if this job is currently running.
+         if self.jobs.get(job_id) is None:
              print('Job ID {} not found'.format(job_id))
+         elif not self.jobs.remove(job_id):
+             print('Job {} is still running!'.format(job_id))
 
    # completion function for the kill command: return only running jobs
    def complete_d(self,text,line,begin_idx,end_idx):
-       job_ids  = [str(j.job_id) for j in self.jobs if j.done()]
+       job_ids  = [str(i) for i in self.jobs.finished_ids()]
        opts = [x+' ' for x in job_ids if x.startswith(text)]
        return opts                        
            
@@ -487,21 +743,29 @@ class WAFterpreter(Cmd):
            print('usage: result <JOBID> or just <JOBID>')
            return
        
-       jobs = dict(zip((j.job_id for j in self.jobs), (j for j in self.jobs)))
+       job = self.jobs.get(job_id)
 
        # verify that job ID is valid
-       if job_id in jobs.keys():
+       if job is not None:
            
-           job = jobs[job_id]
-
            # print job result if it is available, else notify user and return empty
-           if job.running():
+           if not isinstance(job, FinishedJob):
                print('Job {} still running'.format(job_id))
                return
 
+           elif not job.started:
+               print('Job {} was cancelled before it started'.format(job_id))
+
+           elif job.dropped:
+               print('The result of job {} was dropped to stay under MAX_RESULT_BYTES'.format(job_id))
+
            # else return the job's result
            else:
-               result_text =  job.result()
+               try:
+                   result_text = job.result_text()
+               except (IOError, ValueError) as e:
+                   print('Could not read the result of job {}: {}'.format(job_id, e))
+                   return
                print(result_text)
            
        # if job ID is not valid, print error and return
@@ -510,7 +774,7 @@ class WAFterpreter(Cmd):
            
    # completion function for the do_result command: return only completed jobs
    def complete_result(self,text,line,begin_idx,end_idx):
-       job_ids  = [str(j.job_id) for j in self.jobs if j.done()]
+       job_ids  = [str(i) for i in self.jobs.finished_ids()]
        opts = [x+' ' for x in job_ids if x.startswith(text)]
        return opts                                   
 
@@ -536,7 +800,8 @@ class WAFterpreter(Cmd):
        """list the status of running and completed jobs"""
        
        # total number of jobs in the queue or completed
-       total_jobs = len(self.jobs)
+       jobs = self.jobs.values()
+       total_jobs = len(jobs)
        
        # return if there is nothing to show
        if total_jobs == 0:
@@ -544,8 +809,13 @@ class WAFterpreter(Cmd):
            return
        
        # loop over futures objects and tally results
-       jobs_completed = len([j for j in self.jobs if j.done()])
-       print('{} jobs total:  {} complete, {} running\n'.format(total_jobs, jobs_completed, total_jobs-jobs_completed))
+       statuses = [self.job_status(j) for j in jobs]
+       jobs_completed = statuses.count('Completed')
+       jobs_cancelled = statuses.count('Cancelled')
+       print('{} jobs total:  {} complete, {} cancelled, {} running\n'.format(total_jobs, jobs_completed, jobs_cancelled,
+                                                                             total_jobs-jobs_completed-jobs_cancelled))
+       if self.jobs.forgotten:
+           print('({} older finished jobs not kept, see MAX_FINISHED_JOBS)\n'.format(self.jobs.forgotten))
        
        # construct the format string:  left-aligned, space-padded, minimum.maximum
        format_string = "{:<4.4} {:<20.20} {:<15.15}"
@@ -555,20 +825,26 @@ class WAFterpreter(Cmd):
        print(format_string.format(*["-"*20]*3))
        
        # loop through the jobs and display each
-       for j in self.jobs:
-           status = ''
-           if j.done():
-               status = 'Completed'
-           elif j.running():
-               status = 'Running'
-               
+       for j, status in zip(jobs, statuses):
            print(format_string.format( str(j.job_id), j.command_line, status ))
         
    def do_gset(self, args):
-       """set a global variable.  This command takes the form 'gset VARNAME VALUE'."""
+       """set a global variable.  This command takes the form 'gset VARNAME VALUE'; without a VALUE, VARNAME is emptied."""
 
-       (key,value)=string.split(args, maxsplit=1)
+       params = args.split(None, 1)
+       if not params:
+           print('usage: gset VARNAME [VALUE]')
+           return
+       key = params[0]
+       value = params[1].strip() if len(params) > 1 else ''
        self.global_options[key] = value
+
+       if key == 'HOSTDB_FILENAME':
+           self.open_hostdb(value)
+       elif key in ['MAX_INFLIGHT', 'RATE_LIMIT', 'MAX_INFLIGHT_PER_HOST']:
+           self.configure_scheduler()
+       elif key in ['MAX_FINISHED_JOBS', 'MAX_RESULT_BYTES', 'RESULT_SPILL_DIR']:
+           self.configure_jobs()
        
        print('{} => {}'.format(key, value))
        
@@ -884,6 +1160,7 @@ if __name__=='__main__':
     parser.add_argument('--out', dest='outfilename', action='store', help='redirect output to a file')
     parser.add_argument('--pluginpath', dest='plugin_path', action='store', help='specify the root plugin directory', default=DEFAULT_PLUGIN_PATH)
     parser.add_argument('--historyfilename', dest='history_filename', action='store', help='specify name of command history file', default=DEFAULT_HISTORY_FILENAME)
+    parser.add_argument('--hostdb', dest='hostdb_filename', action='store', help='keep the host database in this file instead of in memory', default=DEFAULT_HOSTDB_FILENAME)
     args = parser.parse_args()
 
     # assign default input and output streams
@@ -915,6 +1192,24 @@ if __name__=='__main__':
         wafterpreter.load_history(wafterpreter.global_options['HISTORY_FILENAME'])#DEFAULT_HISTORY_FILENAME)
     except IOError:
         pass
+
+    # the persistent response cache lives next to the history file
+    wafterpreter.global_options['RESPONSE_CACHE'] = os.path.join(os.path.dirname(args.history_filename), DEFAULT_RESPONSE_CACHE_FILENAME)
+    wafterpreter.global_options['RESPONSE_CACHE_TTL'] = DEFAULT_RESPONSE_CACHE_TTL
+
+    # the host database is kept in memory unless a file was asked for
+    wafterpreter.global_options['HOSTDB_FILENAME'] = args.hostdb_filename
+    wafterpreter.open_hostdb(wafterpreter.global_options['HOSTDB_FILENAME'])
+
+    # request scheduling limits, applied to the requests of all plugins
+    wafterpreter.global_options['MAX_INFLIGHT'] = DEFAULT_MAX_INFLIGHT
+    wafterpreter.global_options['RATE_LIMIT'] = DEFAULT_RATE_LIMIT
+    wafterpreter.global_options['MAX_INFLIGHT_PER_HOST'] = DEFAULT_MAX_INFLIGHT_PER_HOST
+
+    # how many finished jobs, and how much of their results, are kept
+    wafterpreter.global_options['MAX_FINISHED_JOBS'] = DEFAULT_MAX_FINISHED_JOBS
+    wafterpreter.global_options['MAX_RESULT_BYTES'] = DEFAULT_MAX_RESULT_BYTES
+    wafterpreter.global_options['RESULT_SPILL_DIR'] = DEFAULT_RESULT_SPILL_DIR
     
     # set default plugin root path...
     wafterpreter.global_options['PLUGIN_PATH'] = DEFAULT_PLUGIN_PATH
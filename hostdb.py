@@ -1,33 +1,125 @@
 #!/usr/bin/env python2
 
 # standard Python library imports
+from itertools import islice
+from contextlib import contextmanager
+from collections import namedtuple
+import threading
+import time
+import json
+import os
+import marshal
+import csv
+import socket
+import struct
 
 # secondary Python library imports
 # (should be in your distribution's repository)
 import sqlite3
 
+# text the csv module needs encoded first: unicode under Python 2, nothing
+# under Python 3, where it writes text as is
+try:
+    CSV_ENCODED_TYPES = (unicode,)
+except NameError:
+    CSV_ENCODED_TYPES = ()
+
+# bulk inserts are sent to sqlite this many rows at a time
+BULK_ROWS = 10000
+
+# service definitions used to name the ports added without a service name
+DEFAULT_SERVICES_FILENAME = '/etc/services'
+
+# queries are paged through this many rows at a time
+PAGE_ROWS = 1000
+
+# rows returned by the query methods, one field per column
+HostRow = namedtuple('HostRow', 'id hostip hostname ipnum')
+PortRow = namedtuple('PortRow', 'id portnum protocol svcname state hostip foreignid')
+WafResultRow = namedtuple('WafResultRow', 'id target hostname portnum wafnames reason requests error scanned')
+ROW_TYPES = {'Hosts': HostRow, 'Ports': PortRow, 'WafResults': WafResultRow}
+
+# seconds a thread waits for another thread's write to the database file to finish
+BUSY_TIMEOUT = 30
+
 # Implements a database of host and port information, with API calls for plugins
 class HostDatabase:
     
-   def __init__(self):
-       self.db = self._create_database()
+   def __init__(self, filename=None, servicedefs=None):
+       """filename: the database file, created if needed.  Without one the
+          database is kept in memory and lost on exit
+          servicedefs: the ServiceDefinitions naming ports added without a
+          service name, by default those of /etc/services"""
+
+       self.filename = filename or ':memory:'
+       if servicedefs is None:
+           servicedefs = get_service_defs(DEFAULT_SERVICES_FILENAME)
+       self.servicedefs = servicedefs
+
+       # each thread (e.g. a backgrounded job) gets its own connection to a
+       # database file.  An in-memory database only exists for the connection
+       # that created it, so that one is shared, and its writes serialized
+       self.local = threading.local()
+       self.lock = threading.RLock()
+       self.shared = None
+       if self.filename == ':memory:':
+           self.shared = sqlite3.connect(':memory:', check_same_thread=False)
+
+       self._create_database()
+
+   def _connection(self):
+       """Private method: return the calling thread's connection to the database"""
+
+       if self.shared is not None:
+           return self.shared
+       db = getattr(self.local, 'db', None)
+       if db is None:
+           db = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT)
+           db.execute("PRAGMA synchronous=NORMAL;")
+           self.local.db = db
+       return db
+
+   @contextmanager
+   def _transaction(self):
+       """Private method: run a block of writes as one transaction, yielding the connection"""
+
+       db = self._connection()
+       if self.shared is not None:
+           with self.lock:
+               with db:
+                   yield db
+       else:
+           with db:
+               yield db
+
+   def close(self):
+       """close the calling thread's connection (or the in-memory database)"""
+
+       if self.shared is not None:
+           self.shared.close()
+       elif getattr(self.local, 'db', None) is not None:
+           self.local.db.close()
+           self.local.db = None
 
    def _create_database(self):
-       """Private method: create an empty database"""
+       """Private method: create the tables and indexes that do not exist yet"""
        
-       self.db = sqlite3.connect(':memory:')
-       self.cursor = self.db.cursor()
-       self.cursor.executescript("""
+       db = self._connection()
+       if self.shared is None:
+           # readers do not block the writer, nor the writer the readers
+           db.execute("PRAGMA journal_mode=WAL;")
+       db.executescript("""
 
-           CREATE TABLE Hosts(
+           CREATE TABLE IF NOT EXISTS Hosts(
                id        INTEGER PRIMARY KEY,
                hostip    TEXT UNIQUE,
-               hostname  TEXT
+               hostname  TEXT,
+               ipnum     INTEGER
                );
         
-           CREATE TABLE Ports(
+           CREATE TABLE IF NOT EXISTS Ports(
                id        INTEGER PRIMARY KEY,
-               portnum   INTEGER CHECK (portnum>0 and portnum<65535),
+               portnum   INTEGER CHECK (portnum>0 and portnum<=65535),
                protocol  TEXT,
                svcname   TEXT,
                state     TEXT,
@@ -37,7 +129,36 @@ class HostDatabase:
                FOREIGN KEY (foreignid) REFERENCES Hosts(id)
                );
 
+           -- a port is known once per host and protocol
+           CREATE UNIQUE INDEX IF NOT EXISTS PortsByHost ON Ports(hostip, portnum, protocol);
+           CREATE INDEX IF NOT EXISTS PortsByNumber ON Ports(portnum, state, protocol);
+
+           -- outcome of the latest WAF identification of each target url
+           CREATE TABLE IF NOT EXISTS WafResults(
+               id        INTEGER PRIMARY KEY,
+               target    TEXT UNIQUE,
+               hostname  TEXT,
+               portnum   INTEGER,
+               wafnames  TEXT,
+               reason    TEXT,
+               requests  INTEGER,
+               error     TEXT,
+               scanned   REAL
+               );
+
+           CREATE INDEX IF NOT EXISTS WafResultsByHost ON WafResults(hostname, portnum);
+
            """)
+
+       # databases made before Hosts had the ipnum column get it, filled in
+       columns = [row[1] for row in db.execute("PRAGMA table_info(Hosts);")]
+       if 'ipnum' not in columns:
+           with self._transaction() as db:
+               db.execute("ALTER TABLE Hosts ADD COLUMN ipnum INTEGER;")
+               db.executemany("UPDATE Hosts SET ipnum=? WHERE id=?;",
+                              [(ip_to_int(hostip), host_id)
+                               for (host_id, hostip) in db.execute("SELECT id, hostip FROM Hosts;").fetchall()])
+       db.execute("CREATE INDEX IF NOT EXISTS HostsByNumber ON Hosts(ipnum);")
            
 
    # ----------- API and Utility Methods ----------------------------------------------
@@ -47,71 +168,397 @@ class HostDatabase:
    #-----------------------------------------------------------------------------------   
 
    def add_host(self, host_ip, host_name):
-       """Database API:  Add a host to the database, where:
+       """Database API:  Add a host to the database, or update its name if it is already there (a name of None keeps the known one), where:
            - host_ip: a string containing the host's Internet Protocol (IP) number
            - host_name: the name associated with this host"""
 
-       # note: FIXME - skip if this is already in the database
-       self.cursor.execute("INSERT INTO Hosts(hostip, hostname) VALUES (?, ?);", (host_ip, host_name))
-       
+       self.add_hosts([(host_ip, host_name)])
 
-   def get_host_iplist(self):
-       results = self.cursor.execute("SELECT hostip from Hosts")
-       return results
-       
+   def add_hosts(self, hosts):
+       """Database API:  Add or update many hosts in a single transaction, where:
+           - hosts: an iterable of (host_ip, host_name) tuples"""
+
+       with self._transaction() as db:
+           for rows in self._batches(hosts):
+               db.executemany("INSERT OR IGNORE INTO Hosts(hostip, hostname, ipnum) VALUES (?, ?, ?);",
+                              [(host_ip, host_name, ip_to_int(host_ip)) for (host_ip, host_name) in rows])
+               db.executemany("UPDATE Hosts SET hostname=COALESCE(?, hostname) WHERE hostip=?;",
+                              [(host_name, host_ip) for (host_ip, host_name) in rows])
+
+   def _batches(self, rows):
+       """Private method: split an iterable of rows into lists of up to BULK_ROWS rows"""
+
+       rows = iter(rows)
+       while True:
+           batch = list(islice(rows, BULK_ROWS))
+           if not batch:
+               return
+           yield batch
+
+   def _name_service(self, row):
+       """Private method: fill in the service name of a port row that has none, and
+          lower-case its protocol"""
+
+       (portnum, protocol, service_name, state, hostip) = row
+       protocol = protocol.lower()
+       if service_name is None:
+           service_name = self.servicedefs.lookup(portnum, protocol)
+       return (portnum, protocol, service_name, state, hostip)
+
+   def _select(self, table, where='', params=(), after=None, limit=None):
+       """Private method: lazily yield the rows of a table matching where, in id order.
+          Rows are fetched a page at a time, each page with its own short query
+          picking up after the last id seen, so any number of these generators can
+          be iterated at once and writes may happen in between."""
+
+       rowtype = ROW_TYPES[table]
+       sql = "SELECT {} FROM {} WHERE {}id>? ORDER BY id LIMIT ?".format(
+           ', '.join(rowtype._fields), table, where + ' AND ' if where else '')
+       last = after if after is not None else -1
+       while limit is None or limit > 0:
+           pagesize = PAGE_ROWS if limit is None else min(PAGE_ROWS, limit)
+           rows = self._connection().execute(sql, list(params) + [last, pagesize]).fetchall()
+           for row in rows:
+               yield rowtype(*row)
+           if len(rows) < pagesize:
+               return
+           last = rows[-1][0]
+           if limit is not None:
+               limit -= len(rows)
+
+   def iter_table(self, table, after=None, limit=None):
+       """Database API:  Lazily yield the rows of table ("Hosts", "Ports" or "WafResults"), where:
+           - after: only rows whose id is greater, e.g. the id of the last row of the previous page
+           - limit: yield at most this many rows"""
+
+       return self._select(table, after=after, limit=limit)
+
+   def get_host_iplist(self, after=None, limit=None, network=None):
+       """Database API:  Lazily yield a HostRow for every host, paged like iter_table(), where:
+           - network: only the hosts in this CIDR block, dash range or address (see parse_ip_range)"""
+
+       if network is None:
+           return self._select('Hosts', after=after, limit=limit)
+       return self._select('Hosts', "ipnum BETWEEN ? AND ?", self._network_range(network), after, limit)
+
+   def _network_range(self, network):
+       """Private method: return the (first, last) ipnum of a network, or raise ValueError"""
+
+       iprange = parse_ip_range(network)
+       if iprange is None:
+           raise ValueError('{} is not an IPv4 network, range or address'.format(network))
+       return list(iprange)
        
    def get_host_id(self, host_ip):
-       results = self.cursor.execute("SELECT id from Hosts WHERE hostip=?",[host_ip])
-       return results[0]
+       """Database API:  Return the id of a host, or None if it is not in the database"""
+
+       row = self._connection().execute("SELECT id from Hosts WHERE hostip=?",[host_ip]).fetchone()
+       if row is None:
+           return None
+       return row[0]
   
    def add_port(self, portnum, port_protocol, service_name, state, hostip):
-       """Database API:  Add port information for a given host to the database, where:
+       """Database API:  Add port information for a given host to the database, or update it, where:
            - host_ip:  a string containing the host's Internet Protocol (IP) number
            - portnum:  a string containing the port number
            - protocol: one of "tcp", "udp"
-           - service_name: name of the service or program responding to queries on this port
+           - service_name: name of the service or program responding to queries on this port;
+             None looks it up in the service definitions
            - status: can be "Open", "Closed", or "Filered". """
            
-       self.cursor.execute("INSERT INTO Ports(portnum, protocol, svcname, state, hostip) VALUES (?, ?, ?, ?, ?);", (portnum, port_protocol, service_name, state, hostip))
+       self.add_ports([(portnum, port_protocol, service_name, state, hostip)])
+
+   def add_ports(self, ports):
+       """Database API:  Add or update port information for many ports in a single transaction, where:
+           - ports: an iterable of (portnum, protocol, service_name, state, host_ip) tuples"""
+
+       with self._transaction() as db:
+           for rows in self._batches(ports):
+               rows = [self._name_service(row) for row in rows]
+               db.executemany("""INSERT OR IGNORE INTO Ports(portnum, protocol, svcname, state, hostip, foreignid)
+                                 VALUES (?, ?, ?, ?, ?, (SELECT id FROM Hosts WHERE hostip=?));""",
+                              [row + (row[4],) for row in rows])
+               db.executemany("""UPDATE Ports SET svcname=?, state=?, foreignid=(SELECT id FROM Hosts WHERE hostip=?)
+                                 WHERE hostip=? AND portnum=? AND protocol=?;""",
+                              [(service_name, state, hostip, hostip, portnum, protocol)
+                               for (portnum, protocol, service_name, state, hostip) in rows])
 
    
-   def get_host_portinfo(self, host_ip):
-       """Database API:  Return all port information for the specified host, where:
+   def get_host_portinfo(self, host_ip, after=None, limit=None):
+       """Database API:  Lazily yield a PortRow for every port of the specified host, paged
+          like iter_table(), where:
            - host_ip: a string containing the host's Internet Protocol (IP) number           
            """
-       results = self.cursor.execute("SELECT * From Ports  WHERE Ports.hostip=?", [host_ip])
-       return results
+       return self._select('Ports', "hostip=?", [host_ip], after, limit)
    
    
-   def list_matching_ports(self, portnum, protocol="TCP", state="open"):
-       """Database API:  Return list of all hosts that have this port open, where:
+   def list_matching_ports(self, portnum, protocol="TCP", state="open", after=None, limit=None, network=None):
+       """Database API:  Lazily yield a PortRow for every host that has this port open, paged
+          like iter_table(), where:
            - portnum:  a string containing the port number
            - protocol: one of "tcp", "udp"
            - service_name: name of the service or program responding to queries on this port
-           - status: optional.  Can be "Open", "Closed", or "Filered". """
+           - status: optional.  Can be "Open", "Closed", or "Filered".
+           - network: optional.  Only the hosts in this CIDR block, dash range or address """
            
-       results = self.cursor.execute("SELECT hostip,portnum,protocol,state FROM Ports WHERE portnum=? AND state=?", [portnum, state])
-       return results
+       where = "portnum=? AND state=? AND protocol=?"
+       params = [portnum, state, protocol.lower()]
+       if network is not None:
+           where += " AND foreignid IN (SELECT id FROM Hosts WHERE ipnum BETWEEN ? AND ?)"
+           params += self._network_range(network)
+       return self._select('Ports', where, params, after, limit)
+
+   def export_table(self, table, fileobj, format='csv'):
+       """Database API:  Write every row of table to fileobj as csv (with a header line) or
+          as JSON lines ("jsonl"), a page at a time.  Returns the number of rows written."""
+
+       return export_rows(self.iter_table(table), fileobj, format, ROW_TYPES[table]._fields)
+
+
+   def add_waf_result(self, target, hostname, portnum, wafnames, reason, requests, error=None, scanned=None):
+       """Database API:  Record the outcome of identifying the WAF in front of a target, replacing
+          the previous one, where:
+           - target: the url that was scanned
+           - hostname, portnum: the host and port the url points at
+           - wafnames: list of the names of the WAFs detected
+           - reason: why the generic detection thinks there is a WAF, or None
+           - requests: number of requests the scan made
+           - error: why the scan failed, or None
+           - scanned: when the scan was made (seconds since the epoch), by default now"""
+
+       if scanned is None:
+           scanned = time.time()
+       with self._transaction() as db:
+           db.execute("""INSERT OR REPLACE INTO WafResults(target, hostname, portnum, wafnames, reason, requests, error, scanned)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
+                      (target, hostname, portnum, json.dumps(list(wafnames)), reason, requests, error, scanned))
+
+   def get_waf_result(self, target):
+       """Database API:  Return the latest WAF identification of a target as a dict with the
+          add_waf_result() fields, or None if it was never scanned"""
+
+       row = self._connection().execute("""SELECT target, hostname, portnum, wafnames, reason, requests, error, scanned
+                                           FROM WafResults WHERE target=?""", [target]).fetchone()
+       if row is None:
+           return None
+       result = dict(zip(('target', 'hostname', 'portnum', 'wafnames', 'reason', 'requests', 'error', 'scanned'), row))
+       result['wafnames'] = json.loads(result['wafnames'])
+       return result
+
+   def is_fresh(self, target, max_age):
+       """Database API:  Return whether target was successfully scanned less than max_age seconds ago"""
+
+       row = self._connection().execute("SELECT 1 FROM WafResults WHERE target=? AND error IS NULL AND scanned>?",
+                                        [target, time.time() - max_age]).fetchone()
+       return row is not None
            
 
 
    
-# loads /etc/services and returns dictionary of "ip/port":servicename
-def load_service_defs(fname):
-    services = parse_service_defs(open(fname).readlines())
-    return services
+# return an IPv4 address in dotted quad notation as an integer, or None if it is not one
+def ip_to_int(ip):
+    parts = ip.split('.') if ip else []
+    if len(parts) != 4 or not all(part.isdigit() and int(part) <= 255 for part in parts):
+        return None
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+# return the dotted quad notation of an integer IPv4 address
+def int_to_ip(ipnum):
+    return socket.inet_ntoa(struct.pack('!I', ipnum))
+
+# return the (first, last) integer addresses of a CIDR block (10.0.0.0/8), a dash
+# range (10.0.0.1-10.0.0.9 or 10.0.0.1-9) or a single IPv4 address; None if spec
+# is none of these (e.g. a hostname).  Raises ValueError for malformed ones.
+def parse_ip_range(spec):
+    if '/' in spec:
+        address, _sep, bits = spec.partition('/')
+        first = ip_to_int(address)
+        if first is None:
+            return None
+        if not bits.isdigit() or int(bits) > 32:
+            raise ValueError('invalid CIDR block {}'.format(spec))
+        hostmask = (1 << (32 - int(bits))) - 1
+        first &= ~hostmask & 0xffffffff
+        return first, first | hostmask
+    if '-' in spec:
+        start, _sep, end = spec.partition('-')
+        first = ip_to_int(start)
+        if first is None:
+            return None
+        if end.isdigit() and int(end) <= 255:
+            last = (first & 0xffffff00) | int(end)
+        else:
+            last = ip_to_int(end)
+        if last is None or last < first:
+            raise ValueError('invalid address range {}'.format(spec))
+        return first, last
+    ipnum = ip_to_int(spec)
+    if ipnum is None:
+        return None
+    return ipnum, ipnum
+
+# set of integers (IPv4 addresses) kept as a bitmap of 2^16 bit chunks,
+# allocated only for the /16s actually used
+class SparseBitmap:
+
+   CHUNK_BITS = 16
+
+   def __init__(self):
+       self.chunks = {}
+
+   def add(self, n):
+       """add n, returning False if it was already there"""
+
+       chunk = self.chunks.get(n >> self.CHUNK_BITS)
+       if chunk is None:
+           chunk = self.chunks[n >> self.CHUNK_BITS] = bytearray(1 << (self.CHUNK_BITS - 3))
+       offset = n & ((1 << self.CHUNK_BITS) - 1)
+       mask = 1 << (offset & 7)
+       if chunk[offset >> 3] & mask:
+           return False
+       chunk[offset >> 3] |= mask
+       return True
+
+   def __contains__(self, n):
+       chunk = self.chunks.get(n >> self.CHUNK_BITS)
+       if chunk is None:
+           return False
+       offset = n & ((1 << self.CHUNK_BITS) - 1)
+       return bool(chunk[offset >> 3] & (1 << (offset & 7)))
+
+# lazily expand target specs (CIDR blocks, dash ranges, addresses and
+# hostnames) into addresses and hostnames, each yielded once.  Raises
+# ValueError for malformed ranges.
+def expand_targets(specs, seen=None):
+    if seen is None:
+        seen = SparseBitmap()
+    hostnames = set()
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        iprange = parse_ip_range(spec)
+        if iprange is None:
+            if spec not in hostnames:
+                hostnames.add(spec)
+                yield spec
+            continue
+        first, last = iprange
+        # xrange does not take longs, which addresses above 127.255.255.255 are on 32 bit builds
+        ipnum = first
+        while ipnum <= last:
+            if seen.add(ipnum):
+                yield int_to_ip(ipnum)
+            ipnum += 1
+
+# write rows (namedtuples) to fileobj as csv or JSON lines without holding
+# more than one of them in memory; returns the number of rows written
+def export_rows(rows, fileobj, format='csv', fields=None):
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(fileobj)
+        if fields is not None:
+            writer.writerow(fields)
+        for row in rows:
+            writer.writerow([v.encode('utf-8') if isinstance(v, CSV_ENCODED_TYPES) else v for v in row])
+            count += 1
+    elif format == 'jsonl':
+        for row in rows:
+            fileobj.write(json.dumps(row._asdict()) + '\n')
+            count += 1
+    else:
+        raise ValueError('unknown export format {}'.format(format))
+    return count
+
+# Service names by (port number, protocol), parsed from a services file (like
+# /etc/services) the first time one is looked up.  With a cachefile the parsed
+# definitions are also kept in that file, and reused while the services file
+# does not change.
+class ServiceDefinitions:
+
+   def __init__(self, filename=DEFAULT_SERVICES_FILENAME, cachefile=None):
+       self.filename = filename
+       self.cachefile = cachefile
+       self.services = None
+       self.lock = threading.Lock()
+
+   def lookup(self, portnum, protocol='tcp'):
+       """return the name of the service on portnum/protocol, or None"""
+
+       try:
+           key = (int(portnum), protocol.lower())
+       except (TypeError, ValueError):
+           return None
+       return self.definitions().get(key)
+
+   def definitions(self):
+       """return the dictionary of (portnum, protocol):servicename, loading it if needed"""
+
+       if self.services is None:
+           with self.lock:
+               if self.services is None:
+                   self.services = self._load()
+       return self.services
+
+   def _load(self):
+       """Private method: read the definitions from the cache file or else parse the services file"""
+
+       try:
+           stat = os.stat(self.filename)
+       except OSError:
+           return {}
+       signature = (stat.st_mtime, stat.st_size)
+
+       if self.cachefile:
+           try:
+               with open(self.cachefile, 'rb') as f:
+                   cached_signature, services = marshal.load(f)
+               if cached_signature == signature:
+                   return services
+           except (IOError, EOFError, ValueError, TypeError):
+               pass
+
+       with open(self.filename) as f:
+           services = parse_service_defs(f)
+
+       if self.cachefile:
+           try:
+               tmpname = '{}.{}.tmp'.format(self.cachefile, os.getpid())
+               with open(tmpname, 'wb') as f:
+                   marshal.dump((signature, services), f)
+               os.rename(tmpname, self.cachefile)
+           except (IOError, OSError):
+               pass
+       return services
+
+# service definitions already known, by services file name
+_service_defs = {}
+_service_defs_lock = threading.Lock()
+
+# return the (shared) ServiceDefinitions of a services file
+def get_service_defs(fname=DEFAULT_SERVICES_FILENAME, cachefile=None):
+    with _service_defs_lock:
+        if fname not in _service_defs:
+            _service_defs[fname] = ServiceDefinitions(fname, cachefile)
+        return _service_defs[fname]
+
+# loads /etc/services and returns dictionary of (port, protocol):servicename
+def load_service_defs(fname, cachefile=None):
+    return get_service_defs(fname, cachefile).definitions()
 
 # feed it lines of services definition (like from /etc/services) and it will return a
-# dictionary of "ip/port":servicename
+# dictionary of (port, protocol):servicename.  The first definition of a port wins.
 def parse_service_defs(lines):
     services = {}
     for _line in lines:
-       line = _line.strip()
-       if line == '': continue
-       if line[0]=='#': continue
-       portAndType = line.split()[1]
-       serviceName = line.split()[0]
-       services[portAndType] = serviceName
+       fields = _line.split('#', 1)[0].split()
+       if len(fields) < 2: continue
+       portnum, _sep, protocol = fields[1].partition('/')
+       try:
+           key = (int(portnum), protocol.lower())
+       except ValueError:
+           continue
+       services.setdefault(key, fields[0])
 
     return services
 
@@ -131,27 +578,19 @@ if __name__=='__main__':
     HOSTNAME='www.test123.com'
     db.add_host(host_ip=IP, host_name=HOSTNAME)
     for portnum in range(20, 100):
-       try:
-           # note: FIXME - skip if this is already in the database
-           service_name = servicedefs[portnum]
-       except Exception:
-           service_name  = "????"
+       service_name = servicedefs.get((portnum, 'tcp'), "????")
        db.add_port(portnum=str(portnum), port_protocol="TCP", service_name=service_name, state="open", hostip=IP)       
 
     IP='2.2.2.2'
     HOSTNAME='www.testABC.com'
     db.add_host(host_ip=IP, host_name=HOSTNAME)    
     for portnum in range(10, 30):
-       try:
-           # note: FIXME - skip if this is already in the database
-           service_name = servicedefs[portnum]
-       except Exception:
-           service_name  = "????"
+       service_name = servicedefs.get((portnum, 'tcp'), "????")
        db.add_port(portnum=str(portnum), port_protocol="TCP", service_name=service_name, state="open", hostip=IP)
 
         
     # sift database for all open port 25/TCP
     ports = db.list_matching_ports("25", protocol="TCP", state="open")
-    print 'ports is', ports
+    print('ports is {}'.format(ports))
     for p in ports: 
-        print p
+        print(p)
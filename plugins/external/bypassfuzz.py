@@ -0,0 +1,208 @@
+# bypassfuzz:  looks for WAF bypasses by mutating a blocked payload, provides the 'bypassfuzz' command
+#
+# - Requires evillib in the same plugin directory
+# - Its requests obey the MAX_INFLIGHT, RATE_LIMIT and MAX_INFLIGHT_PER_HOST global options
+# - Marks the parts of PAYLOAD to mutate with [...], e.g. /search?q=[<script>]
+
+options = {
+
+   # name : (value, default_value, required, description)
+   'TARGET_HOST': ('', '', 'yes', 'Target url, e.g. http://www.example.com:8080'),
+   'PAYLOAD': ('', '', 'yes', 'Path to request, with the parts to mutate between [ and ]'),
+   'MUTATORS': ('', 'unicode,nullify,nullifyspaces,slashspaces,tabifyspaces,crlfspaces,backslashquotes,bruteforce', 'yes',
+                'Comma separated mutators to try, in order; join mutators with + to chain them'),
+   'MAX_BYPASSES': ('', '1', 'no', 'Stop after finding this many bypasses; 0 does not stop'),
+   'MAX_REQUESTS': ('', '1000', 'no', 'Stop after sending this many mutated payloads; 0 does not stop'),
+   'WORKERS': ('', '10', 'no', 'Number of requests sent concurrently'),
+   'PROGRESS_INTERVAL': ('', '5', 'no', 'Seconds between progress reports'),
+   'VERBOSE': ('', '0', 'no', 'Specify verbosity (0-3)'),
+}
+
+# characters left alone when url encoding a mutated payload; % keeps the
+# encodings the mutators already made
+SAFE_CHARS = '/%'
+
+# what each fuzz run is up to, by run number, for the fuzzstatus command
+fuzz_runs = {}
+fuzz_run_counter = [0]
+
+
+# turn the MUTATORS option into a list of evillib mutators
+def parse_mutators(evillib, names):
+    known = {
+        'bruteforce': evillib.bruteforceascii,
+        'unicode': evillib.encodermutator(evillib.unicodeurlencode),
+        'nullify': evillib.encodermutator(evillib.nullify),
+        'nullifyspaces': evillib.encodermutator(evillib.nullifyspaces),
+        'slashspaces': evillib.encodermutator(evillib.slashspaces),
+        'tabifyspaces': evillib.encodermutator(evillib.tabifyspaces),
+        'crlfspaces': evillib.encodermutator(evillib.crlfspaces),
+        'backslashquotes': evillib.encodermutator(evillib.backslashquotes),
+    }
+    mutators = []
+    for name in names.split(','):
+        stages = [stage.strip() for stage in name.split('+') if stage.strip()]
+        if not stages:
+            continue
+        unknown = [stage for stage in stages if stage not in known]
+        if unknown:
+            raise ValueError('unknown mutator {}; choose from {}'.format(unknown[0], ', '.join(sorted(known))))
+        if len(stages) == 1:
+            mutators.append(known[stages[0]])
+        else:
+            mutators.append(evillib.pipemutators(*[[known[stage]] for stage in stages]))
+    return mutators
+
+# url encode what a mutator made, so that no mutation breaks the request line
+def encoded(mutator):
+    import urllib
+
+    def mutate(ourstr):
+        for variant in mutator(ourstr):
+            yield urllib.quote(variant, SAFE_CHARS)
+    return mutate
+
+# the status of a response, None when the server gave none (e.g. it
+# dropped the connection)
+def response_status(result):
+    if result is None:
+        return None
+    response, _body = result
+    return response.status
+
+# classify a response to a mutated payload against the baseline responses
+# to the unmodified payload and to a harmless one
+def classify(status, blocked_status, passed_status):
+    if status == blocked_status:
+        return 'blocked'
+    if status == passed_status:
+        return 'passed'
+    return 'other'
+
+def print_progress(run):
+    import time
+
+    elapsed = max(time.time() - run['started'], 1e-9)
+    print('[fuzz {}] {} sent, {} passed, {} blocked, {} other, {:.1f} req/s'.format(
+        run['id'], run['sent'], run['passed'], run['blocked'], run['other'], run['sent'] / elapsed))
+
+def do_bypassfuzz(args):
+    """Mutate a blocked payload until the WAF lets it through"""
+
+    try:
+        evillib = app.load_library('evillib', plugin_path)
+    except Exception as e:
+        import traceback as t
+        print('could not load evillib: {}'.format(t.format_exc()))
+        return
+
+    try:
+        max_bypasses = int(app.get_option('MAX_BYPASSES', options))
+        max_requests = int(app.get_option('MAX_REQUESTS', options))
+        workers = max(1, int(app.get_option('WORKERS', options)))
+        interval = float(app.get_option('PROGRESS_INTERVAL', options))
+        verbose = int(app.get_option('VERBOSE', options))
+    except ValueError:
+        print('MAX_BYPASSES, MAX_REQUESTS, WORKERS, PROGRESS_INTERVAL and VERBOSE must be numbers')
+        return
+
+    target = app.get_option('TARGET_HOST', options)
+    payload = app.get_option('PAYLOAD', options)
+    if not target or not payload:
+        print('TARGET_HOST and PAYLOAD must be set')
+        return
+
+    import re
+    markers = re.findall(r'(\[.*?\])', payload)
+    if not markers:
+        print('PAYLOAD has no [...] markers to mutate')
+        return
+
+    try:
+        mutators = [encoded(mutator) for mutator in parse_mutators(evillib, app.get_option('MUTATORS', options))]
+    except ValueError as e:
+        print(e)
+        return
+
+    if '://' not in target:
+        target = 'http://' + target
+    pret = evillib.oururlparse(target)
+    if pret is None or not pret[0]:
+        print('{} is not a usable target'.format(target))
+        return
+    (hostname, port, _path, _query, ssl) = pret
+    if port is not None:
+        port = int(port)
+
+    import logging
+    import time
+    logging.basicConfig(level=40 - min(verbose, 4) * 10)
+    engine = evillib.waftoolsengine(hostname, port, ssl, debuglevel=verbose, followredirect=False,
+                                    concurrency=workers, readbody=False, canceltoken=app.cancel_token())
+    engine.log = logging.getLogger('bypassfuzz')
+
+    import urllib
+    run = None
+    try:
+        # baselines: the payload as is should be blocked, a harmless value
+        # in place of each marker should not
+        attack_path = clean_path = payload
+        for marker in markers:
+            attack_path = attack_path.replace(marker, urllib.quote(marker[1:-1], SAFE_CHARS))
+            clean_path = clean_path.replace(marker, 'bywaf')
+        blocked_status = response_status(engine.request(path=attack_path, usecache=False, cacheresponse=False))
+        passed_status = response_status(engine.request(path=clean_path, usecache=False, cacheresponse=False))
+        print('baseline: payload gets {}, harmless request gets {}'.format(blocked_status, passed_status))
+        if blocked_status == passed_status:
+            return 'the unmodified payload is not blocked, nothing to bypass'
+
+        fuzz_run_counter[0] += 1
+        run = dict(id=fuzz_run_counter[0], payload=payload, target=target, started=time.time(),
+                   finished=None, sent=0, passed=0, blocked=0, other=0, bypasses=[])
+        fuzz_runs[run['id']] = run
+
+        paths = evillib.mutatepaths(payload, mutators)
+        if max_requests > 0:
+            import itertools
+            paths = itertools.islice(paths, max_requests)
+
+        last_report = run['started']
+        for path, result in engine.requestpaths(paths):
+            verdict = classify(response_status(result), blocked_status, passed_status)
+            run['sent'] += 1
+            run[verdict] += 1
+            if verdict == 'passed':
+                run['bypasses'].append(path)
+                print('[fuzz {}] bypass: {}'.format(run['id'], path))
+                if max_bypasses > 0 and len(run['bypasses']) >= max_bypasses:
+                    break
+            if time.time() - last_report >= interval:
+                last_report = time.time()
+                print_progress(run)
+    finally:
+        engine.close()
+        if run is not None:
+            run['finished'] = time.time()
+    print_progress(run)
+
+    elapsed = max(run['finished'] - run['started'], 1e-9)
+    return '{} bypasses in {} requests ({:.1f} req/s)\n{}'.format(
+        len(run['bypasses']), run['sent'], run['sent'] / elapsed, '\n'.join(run['bypasses']))
+
+def do_fuzzstatus(args):
+    """Show the progress of bypassfuzz runs"""
+
+    import time
+
+    if not fuzz_runs:
+        print('no bypassfuzz runs yet')
+        return
+
+    format_string = '{:<5} {:<10} {:>8} {:>8} {:>8} {:>8} {:>8}  {}'
+    print(format_string.format('Run', 'State', 'Sent', 'Passed', 'Blocked', 'Other', 'Req/s', 'Payload'))
+    for run_id in sorted(fuzz_runs):
+        run = fuzz_runs[run_id]
+        state = 'Running' if run['finished'] is None else 'Finished'
+        elapsed = max((run['finished'] or time.time()) - run['started'], 1e-9)
+        print(format_string.format(run_id, state, run['sent'], run['passed'], run['blocked'], run['other'],
+                                   '{:.1f}'.format(run['sent'] / elapsed), run['payload']))
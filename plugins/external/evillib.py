@@ -4,9 +4,19 @@ import sys
 import httplib
 import socket
 import urllib
+import time
+import threading
+import hashlib
+import sqlite3
+import json
+import math
+import string
+from collections import OrderedDict, deque
+from itertools import imap, islice, chain
+import concurrent.futures
 from urlparse import urlparse, urlunparse
 import logging
-from BeautifulSoup import BeautifulSoup
+import HTMLParser
 
 __license__ = """
 Copyright (c) 2009, {Sandro Gauci|Wendel G. Henrique}
@@ -153,6 +163,118 @@ def oururlparse(target):
     query = o[4]
     return (hostname,port,path,query,ssl)
     
+def normalizetarget(target):
+    """
+    returns target as a canonical url (lower case host, default port left
+    out, http:// assumed when there is no scheme) or None if it is not usable
+    """
+    target = target.strip()
+    if '://' not in target:
+        target = 'http://' + target
+    pret = oururlparse(target)
+    if pret is None:
+        return
+    (hostname,port,path,query,ssl) = pret
+    if not hostname:
+        return
+    if ssl:
+        scheme,defaultport = 'https','443'
+    else:
+        scheme,defaultport = 'http','80'
+    netloc = hostname.lower()
+    if port and port != defaultport:
+        netloc += ':' + port
+    url = '%s://%s%s' % (scheme,netloc,path)
+    if query:
+        url += '?' + query
+    return url
+
+class bloomfilter:
+    """
+    fixed size set membership test which may give false positives (at a
+    rate of about errorrate once capacity items were added) but never false
+    negatives
+    """
+    def __init__(self,capacity=1000000,errorrate=0.000001):
+        self.size = int(math.ceil(-capacity * math.log(errorrate) / (math.log(2) ** 2)))
+        self.hashes = max(1,int(round(self.size * math.log(2) / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # items added as new, false positives aside
+        self.count = 0
+
+    def positions(self,item):
+        digest = hashlib.md5(item).hexdigest()
+        h1 = int(digest[:16],16)
+        h2 = int(digest[16:],16)
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self,item):
+        for position in self.positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self,item):
+        """
+        add item, returning False if it (probably) was already there
+        """
+        new = False
+        for position in self.positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+class digestset:
+    """
+    exact set membership test remembering an 8 byte digest of each item
+    instead of the item itself. Unlike bloomfilter it never drops an item
+    that was not seen, however many are added, but it grows with every
+    item: about 85 bytes each with the set's overhead
+    """
+    def __init__(self):
+        self.digests = set()
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __contains__(self,item):
+        return hashlib.md5(item).digest()[:8] in self.digests
+
+    def add(self,item):
+        """
+        add item, returning False if it was already there
+        """
+        digest = hashlib.md5(item).digest()[:8]
+        if digest in self.digests:
+            return False
+        self.digests.add(digest)
+        return True
+
+def itertargets(lines,seen=None):
+    """
+    lazily turn lines (e.g. an open host file) into canonical target urls,
+    skipping blank lines, comments, malformed urls and duplicates. Targets
+    are remembered exactly (in a digestset), so no distinct target is lost
+    """
+    log = logging.getLogger('targets')
+    if seen is None:
+        seen = digestset()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        target = normalizetarget(line)
+        if target is None:
+            log.warn('ignoring malformed target %s' % line)
+            continue
+        if seen.add(target):
+            yield target
+
 def modifyurl(path,modfunc,log):
     path = path
     log.debug('path is currently %s' % path)
@@ -186,48 +308,781 @@ def bruteforceascii(ourstr):
             newlistourstr[pos] = chr(i)            
             yield(quote(''.join(newlistourstr)))
 
-def unicodeurlencode(ourstr):
-    newstr = str()
-    for character in ourstr:
-        if unicodemapping.has_key(character):
-            newstr += unicodemapping[character]
-        else:
-            newstr += character
-    return newstr
+# per character lookup tables of the encoders, covering every byte so
+# that no lookup needs a fallback
+unicodetable = dict((chr(i),chr(i)) for i in xrange(256))
+unicodetable.update(unicodemapping)
+nulltable = dict((chr(i),quote(chr(i) + '\x00')) for i in xrange(256))
+slashtable = string.maketrans(' ','/')
+tabtable = string.maketrans(' ','\t')
+crlftable = string.maketrans(' ','\n')
 
+def unicodeurlencode(ourstr):
+    return ''.join(map(unicodetable.get,ourstr,ourstr))
 
 def nullify(ourstr):
-    newstr = str()
-    for character in ourstr:
-        newstr += character + "\x00"
-    return quote(newstr)
+    return ''.join(map(nulltable.__getitem__,ourstr))
 
 def replacechars(ourstr,origchar,newchar):
     newstr = ourstr.replace(origchar,newchar)    
     return newstr
 
+def translatechars(ourstr,table,origchar,newchar):
+    if isinstance(ourstr,unicode):
+        return ourstr.replace(origchar,newchar)
+    return ourstr.translate(table)
+
 def nullifyspaces(ourstr):
     return quote(replacechars(ourstr,' ','\x00'))
 
 def slashspaces(ourstr):
-    return replacechars(ourstr,' ','/')
+    return translatechars(ourstr,slashtable,' ','/')
     
 def tabifyspaces(ourstr):
-    return replacechars(ourstr,' ','\t')
+    return translatechars(ourstr,tabtable,' ','\t')
 
 def crlfspaces(ourstr):
-    return replacechars(ourstr,' ','\n')
+    return translatechars(ourstr,crlftable,' ','\n')
    
 def backslashquotes(ourstr):
     return replacechars(ourstr,"'","\''")
-    
+
+encoders = [unicodeurlencode,nullify,nullifyspaces,slashspaces,
+            tabifyspaces,crlfspaces,backslashquotes]
+
+def chainencoders(encoderchain):
+    """
+    returns a function running a payload through every encoder of
+    encoderchain, in order
+    """
+    encoderchain = tuple(encoderchain)
+    if len(encoderchain) == 1:
+        return encoderchain[0]
+    def encode(ourstr):
+        for encoder in encoderchain:
+            ourstr = encoder(ourstr)
+        return ourstr
+    return encode
+
+def encodebatch(payloads,encoderchain):
+    """
+    lazily encode a list or iterator of payloads through a chain of
+    encoders, yielding the encoded payloads in order
+    """
+    return imap(chainencoders(encoderchain),payloads)
+
+def encodermutator(*encoderchain):
+    """
+    returns a mutator (a function yielding variants of a string) that
+    yields the string run through encoderchain
+    """
+    encode = chainencoders(encoderchain)
+    def mutate(ourstr):
+        yield encode(ourstr)
+    return mutate
+
+def mutatestr(ourstr,mutators):
+    """
+    lazily yield the variants every mutator makes of ourstr, one mutator
+    after the other
+    """
+    return chain.from_iterable(mutator(ourstr) for mutator in mutators)
+
+def pipemutators(*stages):
+    """
+    returns a mutator feeding every variant the mutators of one stage make
+    to all the mutators of the next stage, e.g.
+    pipemutators([bruteforceascii],[encodermutator(slashspaces)])
+    """
+    def stage(variants,mutators):
+        for variant in variants:
+            for newstr in mutatestr(variant,mutators):
+                yield newstr
+    def mutate(ourstr):
+        variants = iter([ourstr])
+        for mutators in stages:
+            variants = stage(variants,mutators)
+        return variants
+    return mutate
+
+def unique(items,seen=None):
+    """
+    lazily drop the items already seen, remembering them in a bloomfilter
+    so memory use stays fixed however many items there are
+    """
+    if seen is None:
+        seen = bloomfilter()
+    for item in items:
+        if seen.add(item):
+            yield item
+
+def mutatepaths(path,mutators,seen=None,encode=False):
+    """
+    lazily yield the unique paths made by replacing each [...] marker of
+    path with the variants mutators make of its contents, the way
+    modifypath does
+    """
+    def paths():
+        for m in set(re.findall('(\[.*?\])',path)):
+            parts = [part.replace(']','').replace('[','') for part in path.split(m)]
+            for newstr in mutatestr(m[1:-1],mutators):
+                if encode:
+                    newstr = urllib.quote(newstr)
+                yield newstr.join(parts)
+    return unique(paths(),seen)
+
+def batches(items,size):
+    """
+    lazily group an iterable into lists of up to size items
+    """
+    items = iter(items)
+    while True:
+        batch = list(islice(items,size))
+        if not batch:
+            return
+        yield batch
+
+class signatureindex:
+    """
+    header signatures compiled once and indexed by header name. For each
+    header the patterns are also joined into alternations, so that a value
+    matching none of them is rejected in one regular expression call (or a
+    few, as each alternation holds at most MAXGROUPS capture groups) and a
+    single pass over a response's headers yields every signature that
+    matches. Alternations are compiled when a header is next matched, so
+    adding signatures stays cheap
+    """
+    # python 2's re allows 100 groups per pattern
+    MAXGROUPS = 90
+
+    def __init__(self):
+        # list of (vendor,header,pattern,ignorecase,compiled); the position
+        # in the list is the signature id
+        self.signatures = list()
+        self.ids = dict()
+        self.byheader = dict()
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def add(self,vendor,header,pattern,ignorecase=True):
+        """
+        register a signature and return its id
+        """
+        header = header.lower()
+        k = (header,pattern,ignorecase)
+        self.lock.acquire()
+        try:
+            if self.ids.has_key(k):
+                return self.ids[k]
+            if ignorecase:
+                flags = re.IGNORECASE
+            else:
+                flags = 0
+            sigid = len(self.signatures)
+            self.signatures.append((vendor,header,pattern,ignorecase,re.compile(pattern,flags)))
+            self.ids[k] = sigid
+            # [sigids,alternations], the latter None until next compiled
+            group = self.byheader.setdefault(header,dict()).setdefault(flags,[list(),None])
+            group[0].append(sigid)
+            group[1] = None
+            self.version += 1
+            return sigid
+        finally:
+            self.lock.release()
+
+    def lookup(self,header,pattern,ignorecase=True):
+        """
+        return the id of a signature, registering it on the fly if needed
+        """
+        sigid = self.ids.get((header.lower(),pattern,ignorecase))
+        if sigid is None:
+            sigid = self.add(None,header,pattern,ignorecase)
+        return sigid
+
+    def alternations(self,flags,group):
+        """
+        return the (compiled alternation,sigids) pairs of a header's
+        signatures, compiling them if signatures were added since
+        """
+        alternations = group[1]
+        if alternations is not None:
+            return alternations
+        self.lock.acquire()
+        try:
+            if group[1] is None:
+                chunks = list()
+                groupcount = 0
+                for sigid in group[0]:
+                    compiled = self.signatures[sigid][4]
+                    if not chunks or groupcount + compiled.groups > self.MAXGROUPS:
+                        chunks.append(list())
+                        groupcount = 0
+                    chunks[-1].append(sigid)
+                    groupcount += compiled.groups
+                group[1] = [(re.compile('|'.join(['(?:%s)' % self.signatures[i][2] for i in sigids]),flags),sigids)
+                            for sigids in chunks]
+            return group[1]
+        finally:
+            self.lock.release()
+
+    def match(self,headers):
+        """
+        headers: list of (name,value) as returned by getheaders()
+        returns the set of ids of the signatures matching these headers
+        """
+        hits = set()
+        for name,value in headers:
+            name = name.lower()
+            groups = self.byheader.get(name)
+            if groups is None:
+                continue
+            # set-cookie can have multiple headers, python gives it to us
+            # concatinated with a comma
+            if name == 'set-cookie':
+                values = value.split(', ')
+            else:
+                values = [value]
+            for flags,group in groups.items():
+                for combined,sigids in self.alternations(flags,group):
+                    for v in values:
+                        if not combined.match(v):
+                            continue
+                        for sigid in sigids:
+                            if self.signatures[sigid][4].match(v):
+                                hits.add(sigid)
+        return hits
+
+    def vendors(self,sigids):
+        return set([self.signatures[sigid][0] for sigid in sigids
+                    if self.signatures[sigid][0] is not None])
+
+class lrucache:
+    """
+    dictionary-like cache which evicts the least recently used entries once
+    it holds more than maxentries entries, or once the sizes of its values
+    as measured by sizeof() add up to more than maxbytes
+    """
+    def __init__(self,maxentries=1000,maxbytes=None,sizeof=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        # key -> (value,size), least recently used first
+        self.entries = OrderedDict()
+        self.totalbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,key):
+        return key in self.entries
+
+    def get(self,key,default=None):
+        self.lock.acquire()
+        try:
+            try:
+                value,size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value,size
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self,key,value):
+        if self.sizeof is not None:
+            size = self.sizeof(value)
+        else:
+            size = 0
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.totalbytes -= self.entries.pop(key)[1]
+            self.entries[key] = value,size
+            self.totalbytes += size
+            while self.entries and (len(self.entries) > self.maxentries or
+                                    (self.maxbytes is not None and self.totalbytes > self.maxbytes)):
+                _key,(_value,oldsize) = self.entries.popitem(last=False)
+                self.totalbytes -= oldsize
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.entries.clear()
+        self.totalbytes = 0
+        self.lock.release()
+
+    def stats(self):
+        return dict(entries=len(self.entries),bytes=self.totalbytes,hits=self.hits,
+                    misses=self.misses,evictions=self.evictions)
+
+def responsesize(r):
+    """
+    size of a cached (response,body) pair, as counted against maxbytes
+    """
+    if not r:
+        return 0
+    return len(r[1])
+
+def cachekey(target,port,ssl,method,path,headers):
+    """
+    compact key for a request which does not depend on the order or the
+    case of the header names
+    """
+    canonical = [str(target),str(port),str(ssl),method,path]
+    for name,value in sorted([(name.lower(),value) for name,value in headers.items()]):
+        canonical.append('%s: %s' % (name,value))
+    return hashlib.sha1('\n'.join(canonical)).digest()
+
+# returned by lrucache.get() on a miss, since None is a valid cached response
+notcached = object()
+
+# response bodies are read this many bytes at a time, and cut off after
+# DEFAULT_MAX_BODY_BYTES. Requests not interested in the body still read
+# (and drop) bodies of up to DRAIN_BYTES to keep their connection alive
+READ_CHUNK_BYTES = 16 * 1024
+DEFAULT_MAX_BODY_BYTES = 1024 * 1024
+DRAIN_BYTES = 64 * 1024
+
+class linkextractor(HTMLParser.HTMLParser):
+    """
+    incremental <a href> extractor. Feed it a page in chunks, as they
+    arrive, and take the links found so far from links()
+    """
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.found = deque()
+
+    def handle_starttag(self,tag,attrs):
+        if tag != 'a':
+            return
+        for name,value in attrs:
+            if name == 'href' and value is not None:
+                self.found.append(value)
+                return
+
+    def links(self):
+        while self.found:
+            yield self.found.popleft()
+
+def iterlinks(chunks):
+    """
+    lazily yield the href of every anchor of a page given as an iterable
+    of chunks. Parsing stops at the first markup HTMLParser gives up on
+    """
+    parser = linkextractor()
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for link in parser.links():
+                yield link
+        parser.close()
+    except HTMLParser.HTMLParseError:
+        pass
+    for link in parser.links():
+        yield link
+
+def iterchunks(body,size=None):
+    if size is None:
+        size = READ_CHUNK_BYTES
+    for offset in xrange(0,len(body),size):
+        yield body[offset:offset+size]
+
+# default limits of querycrawler
+DEFAULT_CRAWL_PAGES = 500
+DEFAULT_CRAWL_FRONTIER = 10000
+
+# default limits of the response cache of each engine
+DEFAULT_CACHE_ENTRIES = 1000
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+
+class storedresponse:
+    """
+    stands in for an httplib response replayed from the persistent cache
+    """
+    def __init__(self,status,reason,version,headers,truncated=False):
+        self.status = status
+        self.reason = reason
+        self.version = version
+        self.headers = headers
+        self.truncated = truncated
+
+    def getheader(self,name,default=None):
+        name = name.lower()
+        for header,value in self.headers:
+            if header == name:
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self.headers)
+
+class diskcache:
+    """
+    persistent response cache in an sqlite database, shared by every engine
+    and kept across sessions. Entries expire ttl seconds after being stored
+    """
+    def __init__(self,filename,ttl=3600):
+        self.filename = filename
+        self.ttl = ttl
+        # sqlite connections may not be shared between threads
+        self.local = threading.local()
+        self.connection().executescript("""
+            CREATE TABLE IF NOT EXISTS Responses(
+                key       TEXT PRIMARY KEY,
+                expires   REAL,
+                status    INTEGER,
+                reason    TEXT,
+                version   INTEGER,
+                headers   TEXT,
+                body      BLOB,
+                truncated INTEGER
+                );
+            """)
+
+    def connection(self):
+        db = getattr(self.local,'db',None)
+        if db is None:
+            db = sqlite3.connect(self.filename,timeout=10)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db = db
+        return db
+
+    def get(self,key):
+        row = self.connection().execute(
+            'SELECT status,reason,version,headers,body,truncated FROM Responses WHERE key=? AND expires>?',
+            (key.encode('hex'),time.time())).fetchone()
+        if row is None:
+            return notcached
+        status,reason,version,headers,body,truncated = row
+        if status is None:
+            # a failure stored by an older version, not worth replaying
+            return notcached
+        headers = [(name.encode('latin-1'),value.encode('latin-1'))
+                   for name,value in json.loads(headers)]
+        return storedresponse(status,reason,version,headers,bool(truncated)),str(body)
+
+    def put(self,key,r):
+        """
+        store a response. Failures (None, e.g. a timeout or a reset) are
+        not stored: they are transient, so they stay in the in-memory cache
+        of the session that saw them
+        """
+        if not r:
+            return
+        response,body = r
+        headers = json.dumps(response.getheaders(),encoding='latin-1')
+        values = (response.status,response.reason,response.version,headers,
+                  sqlite3.Binary(body),int(getattr(response,'truncated',False)))
+        db = self.connection()
+        db.execute('INSERT OR REPLACE INTO Responses VALUES (?,?,?,?,?,?,?,?)',
+                   (key.encode('hex'),time.time()+self.ttl) + values)
+        db.commit()
+
+    def purge(self,expiredonly=False):
+        """
+        delete all entries, or only the expired ones; returns how many
+        """
+        db = self.connection()
+        if expiredonly:
+            cursor = db.execute('DELETE FROM Responses WHERE expires<=?',(time.time(),))
+        else:
+            cursor = db.execute('DELETE FROM Responses')
+        db.commit()
+        return cursor.rowcount
+
+    def stats(self):
+        now = time.time()
+        entries,expired,size = self.connection().execute(
+            'SELECT COUNT(*),SUM(expires<=?),SUM(LENGTH(body)) FROM Responses',(now,)).fetchone()
+        return dict(filename=self.filename,ttl=self.ttl,entries=entries,
+                    expired=expired or 0,bytes=size or 0)
+
+# persistent cache consulted by every engine, see setpersistentcache()
+persistentcache = None
+
+def setpersistentcache(filename,ttl=3600):
+    """
+    enable the persistent response cache, or disable it if filename is None
+    or ttl is 0
+    """
+    global persistentcache
+    if filename is None or ttl <= 0:
+        persistentcache = None
+    elif (persistentcache is None or persistentcache.filename != filename):
+        persistentcache = diskcache(filename,ttl)
+    else:
+        persistentcache.ttl = ttl
+    return persistentcache
+
+class connectionpool:
+    """
+    keeps HTTP/1.1 connections alive between requests, one set of idle
+    connections per (target,port,ssl)
+    maxidle: seconds an idle connection is kept before being evicted
+    maxperhost: maximum number of idle connections kept for each key
+    """
+    def __init__(self,maxidle=10,maxperhost=4,timeout=4):
+        self.maxidle = maxidle
+        self.maxperhost = maxperhost
+        self.timeout = timeout
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def newconnection(self,key):
+        target,port,ssl = key
+        if sys.hexversion > 0x2060000:
+            if ssl:
+                return httplib.HTTPSConnection(target,port,timeout=self.timeout)
+            return httplib.HTTPConnection(target,port,timeout=self.timeout)
+        if ssl:
+            return httplib.HTTPSConnection(target,port)
+        return httplib.HTTPConnection(target,port)
+
+    def getconnection(self,key):
+        """
+        returns (connection,reused) where reused tells if the connection
+        was taken from the idle pool and so might have gone stale
+        """
+        self.lock.acquire()
+        try:
+            self.evictidle(key)
+            idle = self.idle.get(key)
+            if idle:
+                h,_lastused = idle.pop()
+                return h,True
+        finally:
+            self.lock.release()
+        return self.newconnection(key),False
+
+    def releaseconnection(self,key,h,response):
+        """
+        hand back a connection once its response has been read completely
+        """
+        if response.will_close or h.sock is None:
+            h.close()
+            return
+        self.lock.acquire()
+        try:
+            self.evictidle(key)
+            idle = self.idle.setdefault(key,list())
+            if len(idle) < self.maxperhost:
+                idle.append((h,time.time()))
+                return
+        finally:
+            self.lock.release()
+        h.close()
+
+    def evictidle(self,key):
+        """
+        drop idle connections which the server has most likely timed out
+        (the caller must hold the lock)
+        """
+        idle = self.idle.get(key)
+        if not idle:
+            return
+        deadline = time.time() - self.maxidle
+        while idle and idle[0][1] < deadline:
+            h,_lastused = idle.pop(0)
+            h.close()
+
+    def discard(self,key):
+        """
+        close all idle connections for key, e.g. after one of them went stale
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle.pop(key,list())
+        finally:
+            self.lock.release()
+        for h,_lastused in idle:
+            h.close()
+
+    def closeall(self):
+        for key in self.idle.keys():
+            self.discard(key)
+
+# shared by all engines so that scans of the same host reuse connections
+defaultpool = connectionpool()
+
+class hostscheduler:
+    """
+    admits requests before they are sent. Each host (target,port,ssl) gets a
+    token bucket allowing rate requests per second in bursts of up to burst
+    requests, and may have at most hostinflight requests in flight; across
+    all hosts at most maxinflight requests are in flight. A request only
+    waits for its own host's limits, so other hosts keep the global capacity
+    busy. A limit of 0 means unlimited
+    """
+    def __init__(self,maxinflight=20,rate=0,burst=1,hostinflight=0):
+        self.maxinflight = maxinflight
+        self.rate = rate
+        self.burst = burst
+        self.hostinflight = hostinflight
+        # key -> [tokens,lastrefill,inflight,waiting]
+        self.hosts = dict()
+        self.maxhosts = 1024
+        self.inflight = 0
+        self.condition = threading.Condition()
+        self.waiting = 0
+        self.maxwaiting = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.totalwait = 0.0
+        self.maxwait = 0.0
+
+    def configure(self,maxinflight=None,rate=None,burst=None,hostinflight=None):
+        self.condition.acquire()
+        if maxinflight is not None:
+            self.maxinflight = maxinflight
+        if rate is not None:
+            self.rate = rate
+        if burst is not None:
+            self.burst = max(1,burst)
+        if hostinflight is not None:
+            self.hostinflight = hostinflight
+        self.condition.notifyAll()
+        self.condition.release()
+
+    def prune(self,now):
+        """
+        forget idle hosts whose bucket has filled up again
+        """
+        for key,host in self.hosts.items():
+            if host[2] == 0 and host[3] == 0:
+                self.refill(host,now)
+                if self.rate <= 0 or host[0] >= self.burst:
+                    del self.hosts[key]
+
+    def refill(self,host,now):
+        if self.rate > 0:
+            host[0] = min(self.burst,host[0] + (now - host[1]) * self.rate)
+        host[1] = now
+
+    def admissible(self,host):
+        if self.maxinflight > 0 and self.inflight >= self.maxinflight:
+            return False
+        if self.hostinflight > 0 and host[2] >= self.hostinflight:
+            return False
+        return self.rate <= 0 or host[0] >= 1
+
+    def acquire(self,key):
+        started = time.time()
+        self.condition.acquire()
+        try:
+            host = self.hosts.get(key)
+            if host is None:
+                if len(self.hosts) >= self.maxhosts:
+                    self.prune(started)
+                host = self.hosts[key] = [self.burst,started,0,0]
+            host[3] += 1
+            self.waiting += 1
+            self.maxwaiting = max(self.maxwaiting,self.waiting)
+            while True:
+                self.refill(host,time.time())
+                if self.admissible(host):
+                    break
+                if self.rate > 0 and host[0] < 1:
+                    # sleep until the next token, unless a release wakes us
+                    self.condition.wait((1 - host[0]) / self.rate)
+                else:
+                    self.condition.wait()
+            if self.rate > 0:
+                host[0] -= 1
+            host[2] += 1
+            host[3] -= 1
+            self.inflight += 1
+            self.waiting -= 1
+            self.admitted += 1
+            waited = time.time() - started
+            if waited > 0.001:
+                self.delayed += 1
+            self.totalwait += waited
+            self.maxwait = max(self.maxwait,waited)
+        finally:
+            self.condition.release()
+
+    def release(self,key):
+        self.condition.acquire()
+        try:
+            host = self.hosts[key]
+            host[2] -= 1
+            self.inflight -= 1
+            if host[2] == 0 and host[3] == 0 and (self.rate <= 0 or host[0] >= self.burst):
+                # nothing left to remember about this host
+                del self.hosts[key]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            if self.admitted:
+                averagewait = self.totalwait / self.admitted
+            else:
+                averagewait = 0.0
+            return dict(inflight=self.inflight,queued=self.waiting,maxqueued=self.maxwaiting,
+                        hosts=len(self.hosts),admitted=self.admitted,delayed=self.delayed,
+                        averagewait=averagewait,maxwait=self.maxwait)
+        finally:
+            self.condition.release()
+
+# admits the requests of all engines and workers
+DEFAULT_MAX_INFLIGHT = 20
+scheduler = hostscheduler(DEFAULT_MAX_INFLIGHT)
+
+def setmaxinflight(maxinflight):
+    scheduler.configure(maxinflight=maxinflight)
+
+def configurescheduler(options):
+    """
+    apply the MAX_INFLIGHT, RATE_LIMIT and MAX_INFLIGHT_PER_HOST bywaf global
+    options (a dict of strings) to the shared scheduler, and so to the
+    requests of every engine, running ones included. Raises ValueError if a
+    value is not a number
+    """
+    maxinflight = int(options.get('MAX_INFLIGHT',DEFAULT_MAX_INFLIGHT))
+    rate = float(options.get('RATE_LIMIT',0))
+    hostinflight = int(options.get('MAX_INFLIGHT_PER_HOST',0))
+    scheduler.configure(maxinflight=maxinflight,rate=rate,burst=int(max(1,rate)),
+                        hostinflight=hostinflight)
+    return scheduler
+
+class requestcancelled(Exception):
+    """
+    raised by the requests of an engine whose canceltoken was cancelled
+    """
+    pass
+
 class waftoolsengine:
     def __init__(self,target='www.microsoft.com',port=80,ssl=False,
-                 debuglevel=0,path='/',followredirect=True):
+                 debuglevel=0,path='/',followredirect=True,concurrency=1,
+                 cache=None,readbody=True,maxbodybytes=DEFAULT_MAX_BODY_BYTES,
+                 canceltoken=None):
         """
         target: the hostname or ip of the target server
         port: defaults to 80
         ssl: defaults to false
+        concurrency: number of requests this engine may have in flight at
+                     once through requestasync(); 1 keeps it sequential
+        cache: an lrucache for the responses, which may be shared between
+               engines; by default each engine gets its own
+        readbody: whether requests read the response body by default; when
+                  false only the status and headers are kept
+        maxbodybytes: bodies are cut off after this many bytes, None reads
+                      them whole
+        canceltoken: an object whose cancelled() method tells when the job
+                     using this engine was killed; from then on requests
+                     raise requestcancelled instead of being sent
         """
         self.target = target
         if port is None:
@@ -238,24 +1093,49 @@ class waftoolsengine:
         self.port = port
         self.ssl = ssl        
         self.debuglevel=debuglevel
-        self.cachedresponses = dict()
+        if cache is None:
+            cache = lrucache(DEFAULT_CACHE_ENTRIES,DEFAULT_CACHE_BYTES,responsesize)
+        self.cachedresponses = cache
+        self.diskcache = persistentcache
         self.requestnumber = 0
         self.path = path
-        self.redirectno = 0
+        # redirects are counted per thread so that concurrent requests
+        # following their own redirect chains do not interfere
+        self.local = threading.local()
         self.followredirect = followredirect
-        self.crawlpaths = list()
+        self.crawlpaths = set()
+        self.pool = defaultpool
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self.executor = None
+        self.lock = threading.Lock()
+        self.readbody = readbody
+        self.maxbodybytes = maxbodybytes
+        self.canceltoken = canceltoken
+
+    def checkcancelled(self):
+        if self.canceltoken is not None and self.canceltoken.cancelled():
+            raise requestcancelled('request to %s cancelled' % self.target)
 
     def request(self,method='GET',path=None,usecache=True,
                 cacheresponse=True, headers=None,
-                comingfromredir=False):
+                comingfromredir=False,readbody=None):
+        """
+        readbody: read the response body, defaults to the engine's setting.
+        The response gets a truncated attribute telling whether the body
+        returned is incomplete
+        """
+        self.checkcancelled()
         followredirect = self.followredirect
+        if readbody is None:
+            readbody = self.readbody
         if comingfromredir:
-            self.redirectno += 1
-            if self.redirectno >= 5:
+            self.local.redirectno += 1
+            if self.local.redirectno >= 5:
                 self.log.error('We received way too many redirects.. stopping that')
                 followredirect=False
         else:
-            self.redirectno = 0
+            self.local.redirectno = 0
         if path is None:
             path = self.path
         if headers is not None:
@@ -269,44 +1149,40 @@ class waftoolsengine:
             headers['Accept-Charset'] = 'ISO-8859-1,utf-8;q=0.7,*;q=0.7'
         if not 'accept' in knownheaders:
             headers['Accept'] = '*/*'
-        k = str([method,path,headers])
+        k = cachekey(self.target,self.port,self.ssl,method,path,headers)
+        if not readbody:
+            # a headers only response must not be served to body readers
+            k = hashlib.sha1(k + 'headersonly').digest()
         if usecache:                
-            if self.cachedresponses.has_key(k):
+            r = self.cachedresponses.get(k,notcached)
+            if r is notcached and self.diskcache is not None:
+                r = self.diskcache.get(k)
+                if r is not notcached:
+                    self.cachedresponses.put(k,r)
+            if r is not notcached:
                 self.log.debug('Using cached version of %s, %s' % (method,path))
-                return self.cachedresponses[k]
-            else:
-                self.log.debug('%s not found in %s' % (k,self.cachedresponses.keys()))
-        if sys.hexversion > 0x2060000:
-            if self.ssl:
-                h = httplib.HTTPSConnection(self.target,self.port,timeout=4)
-            else:
-                h = httplib.HTTPConnection(self.target,self.port,timeout=4)
-        else:
-            if self.ssl:
-                h = httplib.HTTPSConnection(self.target,self.port)
+                return r
             else:
-                h = httplib.HTTPConnection(self.target,self.port)
-        if self.debuglevel <= 10:
-            if self.debuglevel > 1:
-                h.set_debuglevel(self.debuglevel)
+                self.log.debug('%s %s not found in the cache' % (method,path))
+        key = (self.target,self.port,self.ssl)
+        self.scheduler.acquire(key)
         try:
-            self.log.info('Sending %s %s' % (method,path))
-            h.request(method,path,headers=headers)
-        except socket.error:
-            self.log.warn('Could not initialize connection to %s' % self.target)
+            # the job may have been killed while this request was queued
+            self.checkcancelled()
+            r = self.sendrequest(method,path,headers,readbody)
+        finally:
+            self.scheduler.release(key)
+        if r is False:
             return
+        self.lock.acquire()
         self.requestnumber += 1
-        try:
-            response = h.getresponse()
-            responsebody = response.read()
-            h.close()
-            r = response, responsebody
-        except (socket.error,socket.timeout,httplib.BadStatusLine):
-            self.log.warn('Hey.. they closed our connection!')
-            r = None
+        self.lock.release()
         if cacheresponse:
-            self.cachedresponses[k] = r
+            self.cachedresponses.put(k,r)
+            if self.diskcache is not None:
+                self.diskcache.put(k,r)
         if r:
+            response = r[0]
             if response.status in [301,302,307]:                
                 if followredirect:                    
                     if response.getheader('location'):                        
@@ -324,7 +1200,8 @@ class waftoolsengine:
                                 path = '/'+path
                             if (target,port,ssl) == (self.target,self.port,ssl):
                                 r = self.request(method,path,usecache,cacheresponse,
-                                             headers,comingfromredir=True)
+                                             headers,comingfromredir=True,
+                                             readbody=readbody)
                             else:                                
                                 self.log.warn('Tried to redirect to a different server %s' % newloc)
                         else:
@@ -332,53 +1209,231 @@ class waftoolsengine:
         return r
 
 
-    def querycrawler(self,path=None,curdepth=0,maxdepth=1):
+    def sendrequest(self,method,path,headers,readbody=True):
+        """
+        send one request over a pooled connection and read its response.
+        returns (response,body), None if the connection was closed on us
+        or False if we could not connect at all
+        """
+        key = (self.target,self.port,self.ssl)
+        while True:
+            h,reused = self.pool.getconnection(key)
+            if self.debuglevel <= 10:
+                if self.debuglevel > 1:
+                    h.set_debuglevel(self.debuglevel)
+            try:
+                self.log.info('Sending %s %s' % (method,path))
+                h.request(method,path,headers=headers)
+            except socket.error as e:
+                h.close()
+                if reused and not isinstance(e,socket.timeout):
+                    self.log.debug('Kept-alive connection to %s went stale, reconnecting' % self.target)
+                    self.pool.discard(key)
+                    continue
+                self.log.warn('Could not initialize connection to %s' % self.target)
+                return False
+            try:
+                response = h.getresponse()
+            except socket.timeout:
+                # the target may still be working on the request, so it is
+                # not sent again
+                h.close()
+                self.log.warn('Timed out waiting for %s' % self.target)
+                return None
+            except (socket.error,httplib.BadStatusLine):
+                h.close()
+                if reused:
+                    # nothing came back, so the server had closed the
+                    # kept-alive connection before our request reached it
+                    self.log.debug('Kept-alive connection to %s was reset, reconnecting' % self.target)
+                    self.pool.discard(key)
+                    continue
+                self.log.warn('Hey.. they closed our connection!')
+                return None
+            try:
+                responsebody = self.readresponse(response,readbody)
+            except socket.error:
+                h.close()
+                self.log.warn('Hey.. they closed our connection!')
+                return None
+            if response.truncated and not response.isclosed():
+                # the rest of the body is still coming, so the
+                # connection cannot be used for another request
+                h.close()
+            else:
+                self.pool.releaseconnection(key,h,response)
+            return response, responsebody
+
+    def readresponse(self,response,readbody=True):
+        """
+        read a response body in chunks, stopping after maxbodybytes. Without
+        readbody a short body (going by its Content-Length) is still read,
+        and dropped, so that the connection can be kept alive
+        """
+        if readbody:
+            limit = self.maxbodybytes
+        elif response.length is not None and response.length <= DRAIN_BYTES:
+            limit = DRAIN_BYTES
+        else:
+            limit = 0
+        chunks = list()
+        size = 0
+        while limit is None or size < limit:
+            if limit is None:
+                chunk = response.read(READ_CHUNK_BYTES)
+            else:
+                chunk = response.read(min(READ_CHUNK_BYTES,limit-size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if not readbody:
+            response.truncated = size > 0 or not response.isclosed()
+            return ''
+        response.truncated = not response.isclosed()
+        return ''.join(chunks)
+
+    def requestasync(self,method='GET',path=None,usecache=True,
+                     cacheresponse=True,headers=None,readbody=None):
+        """
+        same as request() but returns a Future. With a concurrency of 1 the
+        request is made right away and the Future is already done
+        """
+        return self.submit(self.request,method,path,usecache,cacheresponse,headers,
+                           readbody=readbody)
+
+    def submit(self,func,*args,**kwargs):
+        if self.concurrency <= 1:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(func(*args,**kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self.lock.acquire()
+        try:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+        finally:
+            self.lock.release()
+        return self.executor.submit(func,*args,**kwargs)
+
+    def gather(self,calls):
+        """
+        run a list of callables taking no arguments through the engine's
+        workers and return their results in the same order
+        """
+        futures = [self.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    def requestpaths(self,paths,method='GET',headers=None,batchsize=None,
+                     usecache=False,cacheresponse=False,readbody=None):
+        """
+        request every path of an iterable (such as mutatepaths()) a batch at
+        a time through the engine's workers, lazily yielding (path, result)
+        pairs where result is what request() returned
+        """
+        if batchsize is None:
+            batchsize = max(1,self.concurrency) * 2
+        def call(path):
+            if headers is None:
+                h = None
+            else:
+                h = dict(headers)
+            return lambda: self.request(method,path,usecache,cacheresponse,h,
+                                        readbody=readbody)
+        for batch in batches(paths,batchsize):
+            self.checkcancelled()
+            results = self.gather([call(path) for path in batch])
+            for path,result in zip(batch,results):
+                yield path,result
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def crawlpage(self,path):
+        """
+        fetch a page and look at its links. Returns the first link with a
+        query string, or None and the paths of the same site links
+        """
         self.log.debug('Crawler is visiting %s' % path)
-        localcrawlpaths = list()        
+        r = self.request(path=path,readbody=True)
+        if r is None:
+            return None,[]
+        response, responsebody = r                
+        paths = list()
+        for href in iterlinks(iterchunks(responsebody)):
+            if not href:
+                continue
+            tmpu = urlparse(href)                    
+            if (tmpu[1] != '') and (self.target != tmpu[1]):
+                # not on the same domain name .. ignore
+                self.log.debug('Ignoring link because it is not on the same site %s' % href)
+                continue
+            if tmpu[0] not in ['http','https','']:
+                self.log.debug('Ignoring link because it is not an http uri %s' % href)
+                continue
+            path = tmpu[2]
+            if not path.startswith('/'):
+                path = '/'+path
+            if len(tmpu[4]) > 0:
+                # found a query .. thats all we need                                                
+                location = urlunparse(('','',path,tmpu[3],tmpu[4],''))
+                self.log.info('Found query %s' % location)
+                return href,[]
+            paths.append(urllib.unquote(path))
+        return None,paths
+
+    def querycrawler(self,path=None,curdepth=0,maxdepth=1,
+                     maxpages=DEFAULT_CRAWL_PAGES,maxfrontier=DEFAULT_CRAWL_FRONTIER):
+        """
+        breadth first crawl starting at path, returning the first link with
+        a query string that any fetched page yields. Up to the engine's
+        concurrency pages are fetched at once; at most maxpages pages are
+        fetched and at most maxfrontier paths wait to be fetched
+        """
         if curdepth > maxdepth:
             self.log.info('maximum depth %s reached' % maxdepth)
             return
-        r = self.request(path=path)
-        if r is None:
-            return
-        response, responsebody = r                
+        if path is None:
+            path = self.path
+        self.crawlpaths.add(path)
+        frontier = deque([(path,curdepth)])
+        pending = dict()
+        pages = 0
         try:
-            soup=BeautifulSoup(responsebody)
-        except:
-            self.log.warn('could not parse the response body')
-            return
-        tags = soup('a')
-        for tag in tags:
-            try:
-                href = tag["href"]
-                if href is not None:
-                    tmpu = urlparse(href)                    
-                    if (tmpu[1] != '') and (self.target != tmpu[1]):
-                        # not on the same domain name .. ignore
-                        self.log.debug('Ignoring link because it is not on the same site %s' % href)
+            while frontier or pending:
+                self.checkcancelled()
+                while frontier and len(pending) < max(1,self.concurrency) and pages < maxpages:
+                    nextpath,depth = frontier.popleft()
+                    pending[self.submit(self.crawlpage,nextpath)] = depth
+                    pages += 1
+                if not pending:
+                    break
+                done,_notdone = concurrent.futures.wait(pending.keys(),
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    depth = pending.pop(future)
+                    href,links = future.result()
+                    if href:
+                        return href
+                    if depth >= maxdepth:
                         continue
-                    if tmpu[0] not in ['http','https','']:
-                        self.log.debug('Ignoring link because it is not an http uri %s' % href)
-                        continue
-                    path = tmpu[2]
-                    if not path.startswith('/'):
-                        path = '/'+path
-                    if len(tmpu[4]) > 0:
-                        # found a query .. thats all we need                                                
-                        location = urlunparse(('','',path,tmpu[3],tmpu[4],''))
-                        self.log.info('Found query %s' % location)
-                        return href                    
-                    if path not in self.crawlpaths:
-                        href = urllib.unquote(path)
-                        self.log.debug('adding %s for crawling' % href)
-                        self.crawlpaths.append(href)
-                        localcrawlpaths.append(href)
-            except KeyError:
-                pass
-        for nextpath in localcrawlpaths:            
-            r = self.querycrawler(path=nextpath,curdepth=curdepth+1,maxdepth=maxdepth)
-            if r:
-                return r
+                    for link in links:
+                        if link in self.crawlpaths:
+                            continue
+                        if len(frontier) >= maxfrontier:
+                            self.log.debug('crawl frontier is full, dropping %s' % link)
+                            break
+                        self.log.debug('adding %s for crawling' % link)
+                        self.crawlpaths.add(link)
+                        frontier.append((link,depth+1))
+        finally:
+            for future in pending:
+                future.cancel()
+        self.log.info('crawled %s pages without finding a query' % pages)
 
 
 def scrambledheader(header):
@@ -392,3 +1447,61 @@ def scrambledheader(header):
             return False
     return True
 
+
+def benchmarklinks(pages,rounds=5):
+    """
+    time iterlinks against BeautifulSoup (if it is installed) on a list of
+    page bodies. Returns a dict of parser name to (pages/s, MB/s, links)
+    """
+    parsers = [('iterlinks',lambda body: list(iterlinks(iterchunks(body))))]
+    try:
+        from BeautifulSoup import BeautifulSoup
+        parsers.append(('BeautifulSoup',
+                        lambda body: [tag.get('href') for tag in BeautifulSoup(body)('a')]))
+    except ImportError:
+        pass
+    size = sum(len(body) for body in pages) * rounds
+    results = dict()
+    for name,parse in parsers:
+        links = 0
+        start = time.time()
+        for i in xrange(rounds):
+            for body in pages:
+                links += len(parse(body))
+        elapsed = max(time.time() - start,1e-9)
+        results[name] = (len(pages) * rounds / elapsed,size / elapsed / (1024 * 1024),links / rounds)
+    return results
+
+def benchmarkencoders(payloads,rounds=5):
+    """
+    time every encoder, and all of them chained, on a list of payloads.
+    Returns a dict of encoder name to payloads/s
+    """
+    results = dict()
+    chains = [(encoder.__name__,[encoder]) for encoder in encoders]
+    chains.append(('all chained',encoders))
+    for name,encoderchain in chains:
+        start = time.time()
+        for i in xrange(rounds):
+            for encoded in encodebatch(payloads,encoderchain):
+                pass
+        elapsed = max(time.time() - start,1e-9)
+        results[name] = len(payloads) * rounds / elapsed
+    return results
+
+if __name__ == '__main__':
+    # python evillib.py [saved page ...]
+    if len(sys.argv) > 1:
+        pages = [open(filename,'rb').read() for filename in sys.argv[1:]]
+    else:
+        row = '<tr><td><a href="/item/%d">item %d</a></td><td class="x">%s</td></tr>\n'
+        pages = ['<html><body><table>' +
+                 ''.join(row % (i,i,'lorem ipsum ' * 10) for i in xrange(2000)) +
+                 '</table><a href="/search?q=1">search</a></body></html>']
+    for name,(pagerate,byterate,links) in sorted(benchmarklinks(pages).items()):
+        print '%-15s %10.1f pages/s %8.2f MB/s %8d links' % (name,pagerate,byterate,links)
+    payloads = ["' or 1=1-- %d" % i for i in xrange(10000)] + \
+               ['<script>alert(%d)</script>' % i for i in xrange(10000)] + \
+               ['../../etc/passwd?%d' % i for i in xrange(10000)]
+    for name,rate in sorted(benchmarkencoders(payloads).items()):
+        print '%-16s %12.0f payloads/s' % (name,rate)
@@ -8,13 +8,18 @@ options = {
    # name : (value, default_value, required, description)
 
    # native wafw00f options
-   'TARGET_HOST': ('', '', 'yes', 'Target host on which to identify WAF; list of hosts separated by spaces'),
+   'TARGET_HOST': ('', '', 'yes', 'Target hosts, urls, CIDR blocks (10.0.0.0/24) or ranges (10.0.0.1-20) on which to identify WAF, separated by spaces'),
    'VERBOSE': ('', '1', 'no', 'Specify verbosity (1-3)'),
    'FIND_ALL': ('', 'yes', 'yes', 'Continue identifying WAFs after finding the first one'),
    'DISABLE_REDIRECT': ('', 'yes', 'yes', 'Do not follow redirections given by 3xx responses'),
 
    # bywaf options 
    'USE_HOSTDB': ('', 'yes', 'yes', 'Use the HostDB to store information about hosts'),
+   'RESCAN_AFTER': ('', '0', 'no', 'With USE_HOSTDB, skip targets scanned less than this many hours ago; 0 scans every target'),
+   'WORKERS': ('', '10', 'no', 'Number of targets scanned concurrently'),
+   'DEDUP': ('', 'exact', 'no', 'How targets are deduplicated: exact (about 85 bytes per distinct target) or bloom (fixed size, see DEDUP_CAPACITY)'),
+   'DEDUP_CAPACITY': ('', '10000000', 'no', 'Targets the bloom DEDUP filter is sized for (about 3.6 bytes each); past it, distinct targets may be skipped'),
+   'HOSTFILE': ('', '', 'no', 'File listing hosts, urls, CIDR blocks or ranges to identify, one per line; - reads standard input'),
 
    # unused options
 #   'LIST': ('', 'yes','yes', 'List all WAFs that we are able to detect'),   
@@ -22,17 +27,120 @@ options = {
 #   'XMLRPC_PORT': ('', '8001', 'yes', 'Specify an alternative port to listen on, default 8001'),
 #   'TARGET_PORT': ('', '', 'yes', 'Target port on which to identify WAF'),
 #   'USE_SSL': ('', 'no', 'yes', 'Enable SSL for scanning this host'),
-#   'HOSTFILE': ('', '', 'no', 'list of hosts to identify; specify one host:port per line'),
 }
 
 
 
+# load a library module living next to this plugin (evillib, wafw00f), once
+def load_library(name):
+    return app.load_library(name, plugin_path)
+
+# enable or disable the persistent response cache according to the
+# RESPONSE_CACHE and RESPONSE_CACHE_TTL global options
+def configure_response_cache(evillib):
+    filename = app.global_options.get('RESPONSE_CACHE', '')
+    try:
+        ttl = int(app.global_options.get('RESPONSE_CACHE_TTL', '0'))
+    except ValueError:
+        print('RESPONSE_CACHE_TTL must be a number of seconds, not using the response cache')
+        ttl = 0
+    return evillib.setpersistentcache(filename or None, ttl)
+
+# lazily expand the CIDR blocks and address ranges among lines into one
+# address each, the way portscan does; urls, hostnames and single addresses
+# pass through.  Malformed ranges are reported and skipped, but a spec with
+# a / that is not a CIDR block is left alone, as it may be an url path.
+def expand_ranges(lines):
+    import hostdb as hostdb_module
+    for line in lines:
+        spec = line.strip()
+        if '://' in spec or ('/' not in spec and '-' not in spec):
+            yield spec
+            continue
+        try:
+            iprange = hostdb_module.parse_ip_range(spec)
+        except ValueError as e:
+            if '/' not in spec:
+                print('ignoring target: {}'.format(e))
+                continue
+            iprange = None
+        if iprange is None:
+            yield spec
+            continue
+        for address in hostdb_module.expand_targets([spec]):
+            yield address
+
+# scan targets (any iterable of urls) with a pool of workers, yielding each
+# result as soon as its target is done.  At most twice as many targets as
+# there are workers are pending at any time.
+def scan_targets(wafw00f, targets, workers, **scan_args):
+    import concurrent.futures
+
+    executor = concurrent.futures.ThreadPoolExecutor(workers)
+    pending = set()
+    try:
+        for target in targets:
+            pending.add(executor.submit(scan_target, wafw00f, target, **scan_args))
+            if len(pending) >= workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for job in done:
+                    yield job.result()
+        for job in concurrent.futures.as_completed(pending):
+            yield job.result()
+    finally:
+        executor.shutdown(wait=False)
+
+# scan a single target, turning unexpected errors into a failed result;
+# cancellation stops the whole scan, so it is not one of them
+def scan_target(wafw00f, target, **scan_args):
+    try:
+        return wafw00f.scantarget(target, **scan_args)
+    except wafw00f.requestcancelled:
+        raise
+    except Exception as e:
+        return dict(target=target, wafname=[], generic=None, requests=0, error=str(e))
+
+# lazily drop the targets the host database has a result for that is
+# younger than max_age seconds, counting them in skipped[0]
+def skip_fresh(hostdb, targets, max_age, skipped):
+    for target in targets:
+        if hostdb.is_fresh(target, max_age):
+            skipped[0] += 1
+            continue
+        yield target
+
+# store a scan result in the host database
+def record_result(hostdb, evillib, result):
+    pret = evillib.oururlparse(result['target'])
+    hostname, portnum = None, None
+    if pret is not None:
+        (hostname, port, _path, _query, ssl) = pret
+        portnum = int(port) if port else (443 if ssl else 80)
+    reason = None
+    if result['generic'] and result['generic']['found']:
+        reason = result['generic']['reason']
+    hostdb.add_waf_result(result['target'], hostname, portnum, result['wafname'], reason,
+                          result['requests'], result['error'])
+
+# one-line summary of a scan result
+def format_result(result):
+    if result['error']:
+        return '{}: {}'.format(result['target'], result['error'])
+    if result['wafname']:
+        verdict = 'behind a {}'.format(' and/or '.join(result['wafname']))
+    elif result['generic'] and result['generic']['found']:
+        verdict = 'seems to be behind a WAF ({})'.format(result['generic']['reason'].replace('\r\n', ' '))
+    else:
+        verdict = 'no WAF detected'
+    return '{}: {} ({} requests)'.format(result['target'], verdict, result['requests'])
+
 # if True, then plugin options will be simulated
 SIMULATE_USER_INPUT = True
         
 # idea: be able to specify TARGET_HOST on the bywaf command line; i.e. "identwaf TARGET_HOST=... TARGET_PORT=..."
 # as well as through plugin options.  Options on the commandline override settings specified in the plugin options.
 def do_identwaf(args):
+    """Identify the WAFs in front of the target hosts"""
     
     #params = args.split()
 
@@ -42,32 +150,162 @@ def do_identwaf(args):
         app.set_option('VERBOSE', '3')
         app.set_option('DISABLE_REDIRECT', 'no')
         app.set_option('FIND_ALL', 'yes')
-       
-    # set up parameters for calling WafW00F
-    params = 'wafw00f ' + ' '.join([
-       '-' + 'v' * int(options['VERBOSE'][0]),  # interpret verbosity
-         '--findall=' + options['FIND_ALL'][0],
-         '--disableredict=' + options['DISABLE_REDIRECT'][0],
-         '--xmlrpc=no',
-         options['TARGET_HOST'][0],
-         ])
 
     # run wafwoof
     try:
-        import os.path
-        import imp
-
-        # load wafwoof and import it
-        wafwoof_path = os.path.join(os.path.dirname(plugin_path), 'wafw00f.py')
-        wafw00f = imp.load_source('wafw00f', wafwoof_path)
-#        print('executing {}'.format(params))
-        
-        # call its main with the parameters we set above
-
-        wafw00f.main(params)
+        # load wafwoof (and the evillib it imports from) and import it
+        evillib = load_library('evillib')
+        wafw00f = load_library('wafw00f')
+        configure_response_cache(evillib)
         
     except Exception as e:
         import traceback as t
         exc_msg = t.format_exc()
         print('could not load wafw000f: {}'.format(exc_msg))
         return        
+
+    try:
+        verbose = int(app.get_option('VERBOSE', options))
+        workers = max(1, int(app.get_option('WORKERS', options)))
+        rescan_after = float(app.get_option('RESCAN_AFTER', options)) * 3600
+        dedup_capacity = max(1, int(app.get_option('DEDUP_CAPACITY', options)))
+    except ValueError:
+        print('VERBOSE, WORKERS, RESCAN_AFTER and DEDUP_CAPACITY must be numbers')
+        return
+
+    # exact deduplication grows with every distinct target; a bloomfilter
+    # stays the same size but may skip distinct targets once past capacity
+    dedup = app.get_option('DEDUP', options)
+    if dedup == 'exact':
+        seen = evillib.digestset()
+    elif dedup == 'bloom':
+        seen = evillib.bloomfilter(capacity=dedup_capacity)
+    else:
+        print('DEDUP must be exact or bloom')
+        return
+
+    hostdb = None
+    if app.get_option('USE_HOSTDB', options) == 'yes':
+        hostdb = getattr(app, 'hostdb', None)
+        if hostdb is None:
+            print('no host database available, results will not be recorded')
+
+    import logging
+    logging.basicConfig(level=wafw00f.calclogginglevel(verbose))
+
+    hostfile_name = app.get_option('HOSTFILE', options)
+    if not app.get_option('TARGET_HOST', options) and not hostfile_name:
+        print('no targets specified in TARGET_HOST or HOSTFILE')
+        return
+
+    import sys
+    hostfile = None
+    if hostfile_name == '-':
+        hostfile = sys.stdin
+    elif hostfile_name:
+        try:
+            hostfile = open(hostfile_name)
+        except IOError as e:
+            print('could not open host file: {}'.format(e))
+            return
+
+    # targets are read, normalized and deduplicated lazily, so host files of
+    # any size are streamed; only the DEDUP set grows (with DEDUP=exact, by
+    # about 85 bytes per distinct target)
+    import itertools
+    lines = app.get_option('TARGET_HOST', options).split()
+    if hostfile:
+        lines = itertools.chain(lines, hostfile)
+    targets = evillib.itertargets(expand_ranges(lines), seen)
+    skipped = [0]
+    if hostdb is not None and rescan_after > 0:
+        targets = skip_fresh(hostdb, targets, rescan_after, skipped)
+
+    # a killed job stops every scan it has in progress at their next request
+    scan_args = dict(findall=app.get_option('FIND_ALL', options) == 'yes',
+                     followredirect=app.get_option('DISABLE_REDIRECT', options) != 'yes',
+                     debuglevel=verbose,
+                     canceltoken=app.cancel_token())
+
+    # report each target as it finishes, keeping only the tallies
+    scanned, detected, failed = 0, 0, 0
+    try:
+        for result in scan_targets(wafw00f, targets, workers, **scan_args):
+            scanned += 1
+            if result['error']:
+                failed += 1
+            elif result['wafname'] or (result['generic'] and result['generic']['found']):
+                detected += 1
+            print('[{}] {}'.format(scanned, format_result(result)))
+            if hostdb is not None:
+                record_result(hostdb, evillib, result)
+    finally:
+        if hostfile and hostfile is not sys.stdin:
+            hostfile.close()
+
+    summary = '{} targets scanned: {} behind a WAF, {} failed'.format(scanned, detected, failed)
+    if skipped[0]:
+        summary += ', {} skipped as recently scanned'.format(skipped[0])
+    if dedup == 'bloom' and seen.count > dedup_capacity:
+        summary += ('\nwarning: {} distinct targets exceeded DEDUP_CAPACITY {}, so some may have been '
+                    'skipped as duplicates; raise DEDUP_CAPACITY or use DEDUP exact'.format(seen.count, dedup_capacity))
+    return summary
+
+def do_responsecache(args):
+    """Show or purge the persistent response cache"""
+
+    params = args.split()
+    if not params:
+        params.append('show')
+
+    filename = app.global_options.get('RESPONSE_CACHE', '')
+    if not filename:
+        print('no response cache file set in the RESPONSE_CACHE global option')
+        return
+
+    evillib = load_library('evillib')
+    cache = configure_response_cache(evillib)
+    if cache is None:
+        # disabled for scans, but can still be inspected and purged
+        cache = evillib.diskcache(filename)
+
+    if params[0] == 'show':
+        stats = cache.stats()
+        format_string = '{:<20.20} {}'
+        print(format_string.format('Response cache', stats['filename']))
+        print(format_string.format('TTL (seconds)', app.global_options.get('RESPONSE_CACHE_TTL', '0')))
+        print(format_string.format('Entries', stats['entries']))
+        print(format_string.format('Expired entries', stats['expired']))
+        print(format_string.format('Body bytes', stats['bytes']))
+    elif params[0] == 'purge':
+        expiredonly = params[1:] == ['expired']
+        print('purged {} entries'.format(cache.purge(expiredonly)))
+    else:
+        print('usage: responsecache [show | purge [expired]]')
+
+def complete_responsecache(text, line, begin_idx, end_idx):
+    words = line.split()
+    if len(words) == 1 or (len(words) == 2 and words[1] not in ['show', 'purge']):
+        return [opt + ' ' for opt in ['show', 'purge'] if opt.startswith(text)]
+    if words[1] == 'purge':
+        return [opt + ' ' for opt in ['expired'] if opt.startswith(text)]
+
+def do_enginestats(args):
+    """Show request scheduler statistics"""
+
+    evillib = load_library('evillib')
+    scheduler = evillib.scheduler
+    stats = scheduler.stats()
+
+    format_string = '{:<25.25} {}'
+    print(format_string.format('Max in flight', scheduler.maxinflight or 'unlimited'))
+    print(format_string.format('Rate limit per host', scheduler.rate or 'unlimited'))
+    print(format_string.format('Max in flight per host', scheduler.hostinflight or 'unlimited'))
+    print(format_string.format('In flight', stats['inflight']))
+    print(format_string.format('Queued', stats['queued']))
+    print(format_string.format('Max queued', stats['maxqueued']))
+    print(format_string.format('Hosts tracked', stats['hosts']))
+    print(format_string.format('Requests admitted', stats['admitted']))
+    print(format_string.format('Requests delayed', stats['delayed']))
+    print(format_string.format('Average wait (s)', '{:.3f}'.format(stats['averagewait'])))
+    print(format_string.format('Max wait (s)', '{:.3f}'.format(stats['maxwait'])))
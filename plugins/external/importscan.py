@@ -0,0 +1,183 @@
+# importscan:  loads nmap and masscan results into the host database, provides the 'importscan' command
+#
+# - Reads nmap XML (-oX, also written by masscan), greppable (-oG, nmap or
+#   masscan) and masscan list (-oL) output, streaming it so that files of any
+#   size are imported in constant memory
+
+options = {
+
+   # name : (value, default_value, required, description)
+   'SCAN_FILE': ('', '', 'yes', 'nmap or masscan output file to import'),
+   'FORMAT': ('', 'auto', 'yes', 'One of auto, xml, greppable, list'),
+   'BATCH_ROWS': ('', '5000', 'no', 'Hosts and ports written per transaction'),
+   'PROGRESS_INTERVAL': ('', '5', 'no', 'Seconds between progress reports'),
+}
+
+FORMATS = ['auto', 'xml', 'greppable', 'list']
+
+
+# guess the format of a scan file from its first line
+def detect_format(f):
+    first = ''
+    for line in f:
+        if line.strip():
+            first = line.strip()
+            break
+    f.seek(0)
+    if first.startswith('<'):
+        return 'xml'
+    if first.startswith('#masscan') or first.split(' ', 1)[0] in ['open', 'closed', 'filtered']:
+        return 'list'
+    return 'greppable'
+
+# the parsers below lazily yield ('host', (hostip, hostname)) and
+# ('port', (portnum, protocol, service_name, state, hostip)) entries
+
+# nmap XML, parsed incrementally; each <host> element is dropped (along with
+# what the root element accumulated) once its entries are yielded
+def parse_xml(f):
+    try:
+        import xml.etree.cElementTree as ElementTree
+    except ImportError:
+        import xml.etree.ElementTree as ElementTree
+
+    root = None
+    for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end' or elem.tag != 'host':
+            continue
+        hostip = None
+        for address in elem.findall('address'):
+            if address.get('addrtype') in ['ipv4', 'ipv6']:
+                hostip = address.get('addr')
+                break
+        if hostip is not None:
+            hostname = elem.find('hostnames/hostname')
+            yield 'host', (hostip, hostname.get('name') if hostname is not None else None)
+            for port in elem.findall('ports/port'):
+                state = port.find('state')
+                service = port.find('service')
+                yield 'port', (port.get('portid'), port.get('protocol'),
+                               service.get('name') if service is not None else None,
+                               state.get('state') if state is not None else None, hostip)
+        elem.clear()
+        root.clear()
+
+# greppable output: Host: 10.0.0.1 (name)<tab>Ports: 80/open/tcp//http///, ...
+def parse_greppable(f):
+    import re
+    host_re = re.compile(r'Host:\s+(\S+)\s+\(([^)]*)\)')
+    for line in f:
+        match = host_re.search(line)
+        if not match or 'Ports:' not in line:
+            continue
+        hostip, hostname = match.group(1), match.group(2) or None
+        yield 'host', (hostip, hostname)
+        ports = line.split('Ports:', 1)[1].split('\t', 1)[0]
+        for port in ports.split(','):
+            fields = port.strip().split('/')
+            if len(fields) < 3 or not fields[0].isdigit():
+                continue
+            yield 'port', (fields[0], fields[2], fields[4] if len(fields) > 4 and fields[4] else None,
+                           fields[1], hostip)
+
+# masscan list output: open tcp 80 10.0.0.1 1390000000
+def parse_list(f):
+    last_hostip = None
+    for line in f:
+        fields = line.split()
+        if len(fields) < 4 or line.startswith('#') or not fields[2].isdigit():
+            continue
+        state, protocol, portnum, hostip = fields[:4]
+        if hostip != last_hostip:
+            yield 'host', (hostip, None)
+            last_hostip = hostip
+        yield 'port', (portnum, protocol, None, state, hostip)
+
+PARSERS = {'xml': parse_xml, 'greppable': parse_greppable, 'list': parse_list}
+
+# write parsed entries to the host database, batch_rows at a time; ports go in
+# after the hosts of their batch.  progress(hosts, ports) is called after
+# each batch.  Stops once token is cancelled.  Returns the number of hosts
+# and ports written.
+def import_entries(hostdb, entries, batch_rows, progress=None, token=None):
+    hosts, ports = [], []
+    host_count, port_count = 0, 0
+    for kind, row in entries:
+        if token is not None and token.cancelled():
+            break
+        if kind == 'host':
+            hosts.append(row)
+        else:
+            ports.append(row)
+        if len(hosts) + len(ports) >= batch_rows:
+            hostdb.add_hosts(hosts)
+            hostdb.add_ports(ports)
+            host_count, port_count = host_count + len(hosts), port_count + len(ports)
+            hosts, ports = [], []
+            if progress:
+                progress(host_count, port_count)
+    hostdb.add_hosts(hosts)
+    hostdb.add_ports(ports)
+    return host_count + len(hosts), port_count + len(ports)
+
+def do_importscan(args):
+    """Import nmap or masscan results into the host database"""
+
+    hostdb = getattr(app, 'hostdb', None)
+    if hostdb is None:
+        print('no host database available')
+        return
+
+    filename = args.strip() or app.get_option('SCAN_FILE', options)
+    if not filename:
+        print('no scan file given in SCAN_FILE or as argument')
+        return
+
+    scan_format = app.get_option('FORMAT', options)
+    if scan_format not in FORMATS:
+        print('FORMAT must be one of {}'.format(', '.join(FORMATS)))
+        return
+
+    try:
+        batch_rows = max(1, int(app.get_option('BATCH_ROWS', options)))
+        interval = float(app.get_option('PROGRESS_INTERVAL', options))
+    except ValueError:
+        print('BATCH_ROWS and PROGRESS_INTERVAL must be numbers')
+        return
+
+    try:
+        f = open(filename, 'rb')
+    except IOError as e:
+        print('could not open scan file: {}'.format(e))
+        return
+
+    import time
+    started = time.time()
+    last_report = [started]
+
+    def progress(hosts, ports):
+        now = time.time()
+        if now - last_report[0] >= interval:
+            last_report[0] = now
+            print('[importscan] {} hosts, {} ports, {:.0f} rows/s'.format(
+                hosts, ports, (hosts + ports) / max(now - started, 1e-9)))
+
+    try:
+        if scan_format == 'auto':
+            scan_format = detect_format(f)
+        hosts, ports = import_entries(hostdb, PARSERS[scan_format](f), batch_rows, progress, app.cancel_token())
+    except SyntaxError as e:
+        # what ElementTree raises on malformed XML
+        print('could not parse {} as {}: {}'.format(filename, scan_format, e))
+        return
+    finally:
+        f.close()
+
+    elapsed = max(time.time() - started, 1e-9)
+    return 'imported {} hosts and {} ports from {} ({}) in {:.1f}s, {:.0f} rows/s'.format(
+        hosts, ports, filename, scan_format, elapsed, (hosts + ports) / elapsed)
+
+def complete_importscan(text, line, begin_idx, end_idx):
+    return app.filename_completer(text, line, begin_idx, end_idx)
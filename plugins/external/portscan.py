@@ -0,0 +1,299 @@
+# portscan:  TCP connect scan recording open, closed and filtered ports in the host database,
+# provides the 'portscan' command
+#
+# - Keeps up to CONCURRENCY non-blocking connects in flight, waiting on them with poll()
+#   (or select() where there is no poll)
+
+options = {
+
+   # name : (value, default_value, required, description)
+   'TARGET_HOST': ('', '', 'yes', 'Hosts, addresses, CIDR blocks (10.0.0.0/24) or ranges (10.0.0.1-20) to scan, separated by spaces'),
+   'PORTS': ('', '21,22,25,80,443,8000,8080,8443', 'yes', 'Ports to scan, e.g. 22,80,8000-8100'),
+   'CONCURRENCY': ('', '500', 'no', 'Connects in flight at once'),
+   'TIMEOUT': ('', '2', 'no', 'Seconds after which an unanswered connect counts as filtered'),
+   'RECORD_STATES': ('', 'open,closed,filtered', 'no', 'Port states recorded in the host database'),
+   'PROGRESS_INTERVAL': ('', '5', 'no', 'Seconds between progress reports'),
+}
+
+# results are written to the host database this many ports at a time
+BATCH_ROWS = 1000
+
+# host names are resolved in this many threads, so that DNS lookups never
+# hold up the connects in flight; while none has resolved yet, the scan
+# checks back every RESOLVE_WAIT seconds
+RESOLVE_WORKERS = 8
+RESOLVE_WAIT = 0.05
+
+
+# turn a port list such as "22,80,8000-8100" into a list of port numbers
+def parse_ports(spec):
+    ports = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _sep, last = part.partition('-')
+        first, last = int(first), int(last or first)
+        if not 0 < first <= last <= 65535:
+            raise ValueError('invalid port range {}'.format(part))
+        ports.extend(range(first, last + 1))
+    return ports
+
+# lazily resolve hosts, RESOLVE_WORKERS at a time in other threads, and yield
+# an (ip, hostname, port) for every port of every address, each address
+# once; unresolvable hosts are reported and skipped.  None is yielded while
+# lookups are pending and none has finished, so callers never block on DNS.
+# named(ip, hostname) is called when a host resolves to an address that was
+# already yielded, so that the name is not lost.
+def iter_endpoints(hosts, ports, named=None):
+    import socket
+    import concurrent.futures
+    import hostdb as hostdb_module
+
+    executor = concurrent.futures.ThreadPoolExecutor(RESOLVE_WORKERS)
+    pending = []        # (host, lookup or None for an address), oldest first
+    seen = hostdb_module.SparseBitmap()
+    hosts = iter(hosts)
+    exhausted = False
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < RESOLVE_WORKERS * 4:
+                try:
+                    host = next(hosts)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if hostdb_module.ip_to_int(host) is not None:
+                    pending.append((host, None))
+                else:
+                    pending.append((host, executor.submit(socket.gethostbyname, host)))
+
+            # take the oldest address or finished lookup
+            for i, (host, lookup) in enumerate(pending):
+                if lookup is None or lookup.done():
+                    del pending[i]
+                    break
+            else:
+                yield None
+                continue
+
+            if lookup is None:
+                ip, hostname = host, None
+            else:
+                try:
+                    ip, hostname = lookup.result(), host
+                except socket.error as e:
+                    print('could not resolve {}: {}'.format(host, e))
+                    continue
+            if not seen.add(hostdb_module.ip_to_int(ip)):
+                if hostname is not None and named is not None:
+                    named(ip, hostname)
+                continue
+            for port in ports:
+                yield ip, hostname, port
+    finally:
+        executor.shutdown(wait=False)
+
+# a poll()-like object waiting for sockets to become writable: select.poll,
+# or a select() based stand in where there is none
+class Poller:
+    def __init__(self):
+        import select
+        self.select = select
+        self.poll = getattr(select, 'poll', None)
+        if self.poll is not None:
+            self.poll = self.poll()
+        self.fds = set()
+
+    def register(self, fd):
+        if self.poll is not None:
+            self.poll.register(fd, self.select.POLLOUT | self.select.POLLERR | self.select.POLLHUP)
+        self.fds.add(fd)
+
+    def unregister(self, fd):
+        if self.poll is not None:
+            self.poll.unregister(fd)
+        self.fds.discard(fd)
+
+    # return the fds that are ready within timeout seconds
+    def wait(self, timeout):
+        if self.poll is not None:
+            return [fd for fd, _event in self.poll.poll(timeout * 1000)]
+        _r, writable, errors = self.select.select([], list(self.fds), list(self.fds), timeout)
+        return set(writable) | set(errors)
+
+# connect to every (ip, hostname, port) of endpoints with up to concurrency
+# connects in flight, lazily yielding (ip, hostname, port, state) where state
+# is open, closed (refused) or filtered (no answer within timeout, or
+# unreachable).  endpoints may yield None when it has nothing ready yet.
+def scan_endpoints(endpoints, concurrency, timeout):
+    import socket
+    import errno
+    import time
+    from collections import deque
+
+    endpoints = iter(endpoints)
+    poller = Poller()
+    inflight = {}           # fd: (socket, endpoint, sequence number)
+    deadlines = deque()     # (deadline, fd, sequence number), oldest first
+    sequence = 0
+    exhausted = False
+
+    # fds are reused, so a deadline only applies while its connect is in flight
+    def current(entry):
+        _deadline, fd, seq = entry
+        return fd in inflight and inflight[fd][2] == seq
+
+    def finish(fd):
+        sock, endpoint, _seq = inflight.pop(fd)
+        poller.unregister(fd)
+        sock.close()
+        return endpoint
+
+    try:
+        while inflight or not exhausted:
+            # start connects until concurrency are in flight
+            starved = False
+            while not exhausted and len(inflight) < concurrency:
+                try:
+                    endpoint = next(endpoints)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if endpoint is None:
+                    starved = True
+                    break
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                err = sock.connect_ex((endpoint[0], endpoint[2]))
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    sequence += 1
+                    fd = sock.fileno()
+                    inflight[fd] = (sock, endpoint, sequence)
+                    deadlines.append((time.time() + timeout, fd, sequence))
+                    poller.register(fd)
+                    continue
+                sock.close()
+                if err == 0:
+                    yield endpoint + ('open',)
+                elif err == errno.ECONNREFUSED:
+                    yield endpoint + ('closed',)
+                else:
+                    yield endpoint + ('filtered',)
+            if not inflight:
+                if starved:
+                    time.sleep(RESOLVE_WAIT)
+                continue
+
+            # wait until the oldest connect times out at the latest, or
+            # until more endpoints may be ready
+            while not current(deadlines[0]):
+                deadlines.popleft()
+            wait = max(0, deadlines[0][0] - time.time())
+            if starved:
+                wait = min(wait, RESOLVE_WAIT)
+            for fd in poller.wait(wait):
+                if fd not in inflight:
+                    continue
+                err = inflight[fd][0].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                endpoint = finish(fd)
+                if err == 0:
+                    yield endpoint + ('open',)
+                elif err == errno.ECONNREFUSED:
+                    yield endpoint + ('closed',)
+                else:
+                    yield endpoint + ('filtered',)
+
+            # connects not answered in time are filtered
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                entry = deadlines.popleft()
+                if current(entry):
+                    yield finish(entry[1]) + ('filtered',)
+    finally:
+        for fd in list(inflight):
+            finish(fd)
+
+def do_portscan(args):
+    """TCP connect scan the target hosts, recording the results in the host database"""
+
+    hostdb = getattr(app, 'hostdb', None)
+    if hostdb is None:
+        print('no host database available')
+        return
+
+    try:
+        ports = parse_ports(app.get_option('PORTS', options))
+        concurrency = max(1, int(app.get_option('CONCURRENCY', options)))
+        timeout = float(app.get_option('TIMEOUT', options))
+        interval = float(app.get_option('PROGRESS_INTERVAL', options))
+    except ValueError as e:
+        print('PORTS, CONCURRENCY, TIMEOUT and PROGRESS_INTERVAL must be numbers: {}'.format(e))
+        return
+
+    specs = app.get_option('TARGET_HOST', options).split()
+    if not specs or not ports:
+        print('no hosts in TARGET_HOST or no ports in PORTS')
+        return
+
+    # networks are expanded lazily, one address at a time
+    import hostdb as hostdb_module
+    try:
+        for spec in specs:
+            hostdb_module.parse_ip_range(spec)
+    except ValueError as e:
+        print(e)
+        return
+    hosts = hostdb_module.expand_targets(specs)
+    record_states = set(state.strip() for state in app.get_option('RECORD_STATES', options).split(','))
+
+    import time
+    token = app.cancel_token()
+    counts = dict(open=0, closed=0, filtered=0)
+    # hosts seen, by address, kept compact for scans of large networks
+    scanned_hosts, known_hosts = hostdb_module.SparseBitmap(), hostdb_module.SparseBitmap()
+    host_count = 0
+    host_rows, port_rows = [], []
+    started = last_report = time.time()
+
+    # names of addresses scanned under another spec (e.g. "127.0.0.1
+    # localhost"), recorded with the host if it is recorded at all
+    late_names = {}
+    def named(ip, hostname):
+        ipnum = hostdb_module.ip_to_int(ip)
+        if ipnum in known_hosts:
+            host_rows.append((ip, hostname))
+        else:
+            late_names.setdefault(ipnum, hostname)
+
+    endpoints = iter_endpoints(hosts, ports, named)
+    for ip, hostname, port, state in scan_endpoints(endpoints, concurrency, timeout):
+        if token is not None and token.cancelled():
+            break
+        counts[state] += 1
+        ipnum = hostdb_module.ip_to_int(ip)
+        if scanned_hosts.add(ipnum):
+            host_count += 1
+        if state == 'open':
+            print('{}:{} open'.format(hostname or ip, port))
+        if state in record_states:
+            if known_hosts.add(ipnum):
+                host_rows.append((ip, hostname or late_names.pop(ipnum, None)))
+            # a service name of None is filled in from the service definitions
+            port_rows.append((port, 'tcp', None, state, ip))
+        if len(port_rows) >= BATCH_ROWS:
+            hostdb.add_hosts(host_rows)
+            hostdb.add_ports(port_rows)
+            host_rows, port_rows = [], []
+        if time.time() - last_report >= interval:
+            last_report = time.time()
+            print('[portscan] {} open, {} closed, {} filtered, {:.0f} connects/s'.format(
+                counts['open'], counts['closed'], counts['filtered'],
+                sum(counts.values()) / max(last_report - started, 1e-9)))
+    hostdb.add_hosts(host_rows)
+    hostdb.add_ports(port_rows)
+
+    elapsed = max(time.time() - started, 1e-9)
+    return '{} ports scanned on {} hosts in {:.1f}s ({:.0f} connects/s): {} open, {} closed, {} filtered'.format(
+        sum(counts.values()), host_count, elapsed, sum(counts.values()) / elapsed,
+        counts['open'], counts['closed'], counts['filtered'])
@@ -39,12 +39,18 @@ import logging
 import socket
 import sys
 import random
+import weakref
+from functools import partial
 
 currentDir = os.getcwd()
 scriptDir = os.path.dirname(sys.argv[0]) or '.'
 os.chdir( scriptDir )
 
-from libs.evillib import *
+try:
+    from libs.evillib import *
+except ImportError:
+    # loaded as a bywaf plugin library, next to evillib
+    from evillib import *
 
 __version__ = '0.9.0'
 
@@ -75,15 +81,24 @@ class WafW00F(waftoolsengine):
     isaservermatch = 'Forbidden ( The server denied the specified Uniform Resource Locator (URL). Contact the server administrator.  )'
     
     def __init__(self,target='www.microsoft.com',port=80,ssl=False,
-                 debuglevel=0,path='/',followredirect=True):
+                 debuglevel=0,path='/',followredirect=True,concurrency=1,
+                 cache=None,canceltoken=None):
         """
         target: the hostname or ip of the target server
         port: defaults to 80
         ssl: defaults to false
+        concurrency: number of probes sent at once, defaults to 1
+        cache: response cache to use instead of a private one
+        canceltoken: stops the detection when cancelled, see waftoolsengine
         """
-        waftoolsengine.__init__(self,target,port,ssl,debuglevel,path,followredirect)
+        # none of the detections look at response bodies
+        waftoolsengine.__init__(self,target,port,ssl,debuglevel,path,followredirect,
+                                concurrency,cache,readbody=False,canceltoken=canceltoken)
         self.log = logging.getLogger('wafw00f')
         self.knowledge = dict(generic=dict(found=False,reason=''),wafname=list())
+        # picked once so that the invalid host probe can be cached and planned
+        self.randomhost = str(random.randrange(100000,999999))
+        self.signaturecache = weakref.WeakKeyDictionary()
         
     def normalrequest(self,usecache=True,cacheresponse=True,headers=None):
         return self.request(usecache=usecache,cacheresponse=cacheresponse,headers=headers)
@@ -99,8 +114,7 @@ class WafW00F(waftoolsengine):
         return self.request(path=self.path+self.dirtravstring,usecache=usecache,cacheresponse=cacheresponse)
         
     def invalidhost(self,usecache=True,cacheresponse=True):
-        randomnumber = random.randrange(100000,999999)
-        return self.request(headers={'Host':str(randomnumber)})
+        return self.request(headers={'Host':self.randomhost})
         
     def cleanhtmlencoded(self,usecache=True,cacheresponse=True):
         string = self.path + quote(self.cleanhtmlstring) + '.html'
@@ -126,11 +140,58 @@ class WafW00F(waftoolsengine):
         # thanks j0e
         string = self.path + 'cmd.exe'
         return self.request(path=string,usecache=usecache,cacheresponse=cacheresponse)
+
+    def longtransferencoding(self,usecache=True,cacheresponse=True):
+        # credit goes to W3AF
+        headers = dict()
+        headers['Transfer-Encoding'] = 'z' * 1025
+        return self.normalrequest(usecache=usecache,cacheresponse=cacheresponse,headers=headers)
+
+    def urlscanheaders(self,usecache=True,cacheresponse=True):
+        testheaders = dict()
+        testheaders['Translate'] = 'z'*10
+        testheaders['If'] = 'z'*10
+        testheaders['Lock-Token'] = 'z'*10
+        testheaders['Transfer-Encoding'] = 'z'*10
+        return self.normalrequest(usecache=usecache,cacheresponse=cacheresponse,headers=testheaders)
+
+    def atsignquery(self,usecache=True,cacheresponse=True):
+        newpath = self.path + '?nx=@@'
+        return self.request(path=newpath,usecache=usecache,cacheresponse=cacheresponse)
     
     attacks = [cmddotexe,directorytraversal,xssstandard,protectedfolder,xssstandardencoded]
+
+    # the probes genericdetect sends on top of those of the WAF detections
+    genericprobes = [normalrequest,cleanhtml,xssstandard,cleanhtmlencoded,
+                     xssstandardencoded] + attacks
+
+    def planprobes(self,vendors=None,extra=()):
+        """
+        returns the distinct probes needed by the detections of the given
+        vendors (all of them by default) plus any extra probes
+        """
+        if vendors is None:
+            vendors = self.wafdetectionsprio
+        plan = list(extra)
+        for vendor in vendors:
+            plan.extend(self.wafprobes[vendor])
+        unique = list()
+        for probe in plan:
+            if probe not in unique:
+                unique.append(probe)
+        return unique
+
+    def fetchprobes(self,probes):
+        """
+        send each probe once, concurrently if the engine allows it, so that
+        the detections are then evaluated against cached responses only
+        """
+        self.gather([partial(probe,self) for probe in probes])
     
     def genericdetect(self,usecache=True,cacheresponse=True):        
         reason = ''
+        if self.concurrency > 1:
+            self.fetchprobes(self.planprobes(extra=self.genericprobes))
         reasons = ['Blocking is being done at connection/packet level.',
                    'The server header is different when an attack is detected.',
                    'The server returned a different response code when a string trigged the blacklist.',
@@ -218,9 +279,8 @@ class WafW00F(waftoolsengine):
         return False
 
     def matchheader(self,headermatch,attack=False,ignorecase=True):
-        import re
-        detected = False
         header,match = headermatch
+        sigid = self.signatures.lookup(header,match,ignorecase)
         if attack:
             requests = self.attacks
         else:
@@ -230,26 +290,39 @@ class WafW00F(waftoolsengine):
             if r is None:                
                 return
             response,responsebody = r
-            headerval = response.getheader(header)
-            if headerval:
-                # set-cookie can have multiple headers, python gives it to us
-                # concatinated with a comma
-                if header == 'set-cookie':
-                    headervals = headerval.split(', ')
-                else:
-                    headervals = [headerval]
-                for headerval in headervals:
-                    if ignorecase:
-                        if re.match(match,headerval,re.IGNORECASE):
-                            detected = True
-                            break
-                    else:
-                        if re.match(match,headerval):
-                            detected = True
-                            break
-                if detected:
-                    break
-        return detected
+            if sigid in self.signaturehits(response):
+                return True
+        return False
+
+    def signaturehits(self,response):
+        """
+        ids of all signatures matching the headers of a response. Worked
+        out in one pass and remembered for as long as the response is alive
+        """
+        version,hits = self.signaturecache.get(response,(None,None))
+        if version != self.signatures.version:
+            version = self.signatures.version
+            hits = self.signatures.match(response.getheaders())
+            self.signaturecache[response] = version,hits
+        return hits
+
+    def matchingvendors(self,attack=False):
+        """
+        returns every vendor with a registered signature matching the
+        response to the normal request (or to the attacks)
+        """
+        if attack:
+            requests = self.attacks
+        else:
+            requests = [self.normalrequest]
+        hits = set()
+        for request in requests:
+            r = request(self)
+            if r is None:
+                continue
+            response,responsebody = r
+            hits.update(self.signaturehits(response))
+        return self.signatures.vendors(hits)
 
     def isbigip(self):
         return self.matchheader(('X-Cnection','^close$'), attack=True)
@@ -297,9 +370,7 @@ class WafW00F(waftoolsengine):
         response,responsebody = r
         if response.status == 404:
             return
-        headers = dict()
-        headers['Transfer-Encoding'] = 'z' * 1025
-        r = self.normalrequest(headers=headers)
+        r = self.longtransferencoding()
         if r is None:
             return 
         response,responsebody = r         
@@ -408,16 +479,11 @@ class WafW00F(waftoolsengine):
     
     def isurlscan(self):
         detected = False
-        testheaders = dict()
-        testheaders['Translate'] = 'z'*10
-        testheaders['If'] = 'z'*10
-        testheaders['Lock-Token'] = 'z'*10
-        testheaders['Transfer-Encoding'] = 'z'*10
         r = self.normalrequest()
         if r is None:
             return
         response,_tmp = r
-        r = self.normalrequest(headers=testheaders)
+        r = self.urlscanheaders()
         if r is None:
             return 
         response2,_tmp = r
@@ -434,8 +500,7 @@ class WafW00F(waftoolsengine):
         response,responsebody=r
         if response.status == 403:
             return detected
-        newpath = self.path + '?nx=@@'
-        r = self.request(path=newpath)
+        r = self.atsignquery()
         if r is None:
             return 
         response,responsebody = r
@@ -495,6 +560,26 @@ class WafW00F(waftoolsengine):
         return detected
 
 
+    # header signatures, compiled once when the class is loaded
+    signatures = signatureindex()
+    signatures.add('IBM DataPower','X-Backside-Transport','^(OK|FAIL)')
+    signatures.add('Profense','server','profense')
+    signatures.add('NetContinuum','set-cookie','^NCI__SessionId=')
+    signatures.add('HyperGuard','set-cookie','^WODSESSION=')
+    signatures.add('Barracuda','set-cookie','^barra_counter_session=')
+    signatures.add('Airlock','set-cookie','^AL[_-]?(SESS|LB)=')
+    signatures.add('BinarySec','server','BinarySec')
+    signatures.add('F5 Trafficshield','cookie','^ASINFO=')
+    signatures.add('F5 Trafficshield','server','F5-TrafficShield')
+    signatures.add('F5 ASM','set-cookie','^TS[a-zA-Z0-9]{3,6}=')
+    signatures.add('Teros','set-cookie','^st8id=')
+    signatures.add('DenyALL','set-cookie','^sessioncookie=')
+    signatures.add('BIG-IP','X-Cnection','^close$')
+    signatures.add('Citrix NetScaler','set-cookie','^(ns_af=|citrix_ns_id|NSC_)')
+    signatures.add('Citrix NetScaler','Cneonction','close')
+    signatures.add('Citrix NetScaler','nnCoection','close')
+    signatures.add('dotDefender','X-dotDefender-denied','^1$')
+
     wafdetections = dict()
     # easy ones
     wafdetections['IBM Web Application Security'] = isibm
@@ -529,10 +614,39 @@ class WafW00F(waftoolsengine):
                          'dotDefender','webApp.secure', # removed for now 'ModSecurity (positive model)',                         
                          'BIG-IP','URLScan','WebKnight',
                          'SecureIIS','Imperva','ISA Server']
+
+    # the probes each detection sends, so that findall mode can fetch the
+    # union of them once and then match every detection against the cache
+    wafprobes = dict()
+    wafprobes['IBM Web Application Security'] = [protectedfolder]
+    wafprobes['IBM DataPower'] = [normalrequest]
+    wafprobes['Profense'] = [normalrequest]
+    wafprobes['ModSecurity'] = attacks
+    wafprobes['ISA Server'] = [invalidhost]
+    wafprobes['NetContinuum'] = [normalrequest]
+    wafprobes['HyperGuard'] = [normalrequest]
+    wafprobes['Barracuda'] = [normalrequest]
+    wafprobes['Airlock'] = [normalrequest]
+    wafprobes['BinarySec'] = [normalrequest]
+    wafprobes['F5 Trafficshield'] = [normalrequest]
+    wafprobes['F5 ASM'] = [normalrequest]
+    wafprobes['Teros'] = [normalrequest]
+    wafprobes['DenyALL'] = [normalrequest] + attacks
+    wafprobes['BIG-IP'] = attacks
+    wafprobes['Citrix NetScaler'] = [normalrequest] + attacks
+    wafprobes['webApp.secure'] = [normalrequest,atsignquery]
+    wafprobes['WebKnight'] = attacks
+    wafprobes['URLScan'] = [normalrequest,urlscanheaders]
+    wafprobes['SecureIIS'] = [normalrequest,longtransferencoding]
+    wafprobes['dotDefender'] = attacks
+    wafprobes['Imperva'] = attacks
     
     def identwaf(self,findall=False):
         detected = list()
+        if findall:
+            self.fetchprobes(self.planprobes())
         for wafvendor in self.wafdetectionsprio:
+            self.checkcancelled()
             self.log.info('Checking for %s' % wafvendor)
             if self.wafdetections[wafvendor](self):
                 detected.append(wafvendor)
@@ -548,45 +662,54 @@ def calclogginglevel(verbosity):
         level = 0
     return level
 
+# number of scanned urls the XML-RPC interface keeps around
+DEFAULT_API_CACHE_ENTRIES = 100
+
 class wafwoof_api:
-    def __init__(self):
-        self.cache = dict()
+    def __init__(self,maxentries=DEFAULT_API_CACHE_ENTRIES):
+        self.cache = lrucache(maxentries)
+        # one response cache for all urls, so that the memory held by the
+        # server is bounded no matter how many urls it has seen
+        self.responses = lrucache(DEFAULT_CACHE_ENTRIES,DEFAULT_CACHE_BYTES,responsesize)
+
+    def cachestats(self):
+        return dict(scans=self.cache.stats(),responses=self.responses.stats())
         
     def vendordetect(self,url,findall=False):            
-        if self.cache.has_key(url):
-            wafw00f = self.cache[url]
-        else:
+        wafw00f = self.cache.get(url)
+        if wafw00f is None:
             r = oururlparse(url)
             if r is None:
                 return ['']
             (hostname,port,path,query,ssl) = r
-            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl)
-            self.cache[url] = wafw00f
+            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl,
+                              cache=self.responses)
+            self.cache.put(url,wafw00f)
         return wafw00f.identwaf(findall=findall)
     
     def genericdetect(self,url):            
-        if self.cache.has_key(url):
-            wafw00f = self.cache[url]
-        else:
+        wafw00f = self.cache.get(url)
+        if wafw00f is None:
             r = oururlparse(url)
             if r is None:
                 return {}
             (hostname,port,path,query,ssl) = r
-            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl)
-            self.cache[url] = wafw00f
+            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl,
+                              cache=self.responses)
+            self.cache.put(url,wafw00f)
         wafw00f.genericdetect()
         return wafw00f.knowledge['generic']
         
     def alltests(self,url,findall=False):
-        if self.cache.has_key(url):
-            wafw00f = self.cache[url]
-        else:
+        wafw00f = self.cache.get(url)
+        if wafw00f is None:
             r = oururlparse(url)
             if r is None:
                 return {}
             (hostname,port,path,query,ssl)  = r
-            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl)
-            self.cache[url] = wafw00f
+            wafw00f = WafW00F(target=hostname,port=port,path=path,ssl=ssl,
+                              cache=self.responses)
+            self.cache.put(url,wafw00f)
         wafw00f.identwaf(findall=findall)
         if (len(wafw00f.knowledge['wafname']) == 0) or (findall):
             wafw00f.genericdetect()
@@ -595,6 +718,58 @@ class wafwoof_api:
 
 
 
+def fixtarget(target):
+    log = logging.getLogger('wafw00f')
+    if not (target.startswith('http://') or target.startswith('https://')):
+        log.info('The url %s should start with http:// or https:// .. fixing (might make this unusable)' % target)
+        target = 'http://' + target
+    return target
+
+def newattacker(target,debuglevel=0,followredirect=True,concurrency=1,cache=None,
+                canceltoken=None):
+    """
+    returns a WafW00F for the url target, or None if it is not well formed
+    """
+    pret = oururlparse(target)
+    if pret is None:
+        return
+    (hostname,port,path,query,ssl) = pret
+    return WafW00F(hostname,port=port,ssl=ssl,debuglevel=debuglevel,path=path,
+                   followredirect=followredirect,concurrency=concurrency,cache=cache,
+                   canceltoken=canceltoken)
+
+def scantarget(target,findall=False,debuglevel=0,followredirect=True,
+               concurrency=1,cache=None,canceltoken=None):
+    """
+    identify the WAFs in front of one url, falling back to the generic
+    detection when none is found (or always with findall). Returns a dict
+    with the target, the WAF names, the generic detection knowledge, the
+    number of requests and an error message if the scan could not be made.
+    Raises requestcancelled once canceltoken is cancelled
+    """
+    log = logging.getLogger('wafw00f')
+    target = fixtarget(target)
+    result = dict(target=target,wafname=list(),generic=None,requests=0,error=None)
+    attacker = newattacker(target,debuglevel,followredirect,concurrency,cache,canceltoken)
+    if attacker is None:
+        result['error'] = 'The url %s is not well formed' % target
+        return result
+    try:
+        log.info('starting wafw00f on %s' % target)
+        if attacker.normalrequest() is None:
+            result['error'] = 'Site %s appears to be down' % target
+            return result
+        waf = attacker.identwaf(findall)
+        log.info('Ident WAF: %s' % waf)
+        result['wafname'] = waf
+        if findall or len(waf) == 0:
+            attacker.genericdetect()
+            result['generic'] = attacker.knowledge['generic']
+        return result
+    finally:
+        result['requests'] = attacker.requestnumber
+        attacker.close()
+
 def xmlrpc_interface(bindaddr=('localhost',8001)):
     from SimpleXMLRPCServer import SimpleXMLRPCServer
     from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
@@ -625,6 +800,8 @@ def main():
                       help="Find all WAFs, do not stop testing on the first one")
     parser.add_option('-r','--disableredirect',action='store_false',dest='followredirect',
                       default=True, help='Do not follow redirections given by 3xx responses')
+    parser.add_option('-c','--concurrency',dest='concurrency', type='int',
+                      default=1,help='Number of probes to send concurrently, default 1')
     parser.add_option('-t','--test',dest='test',
                       help='Test for one specific WAF')
     parser.add_option('-l','--list',dest='list', action='store_true',
@@ -654,23 +831,17 @@ def main():
         parser.error("we need a target site")
     targets = args
     for target in targets:
-        if not (target.startswith('http://') or target.startswith('https://')):
-            log.info('The url %s should start with http:// or https:// .. fixing (might make this unusable)' % target)
-            target = 'http://' + target
+        target = fixtarget(target)
         print "Checking %s" % target
-        pret = oururlparse(target)
-        if pret is None:
-            log.critical('The url %s is not well formed' % target)
-            sys.exit(1)
-        (hostname,port,path,query,ssl) = pret
-        log.info('starting wafw00f on %s' % target)
-        attacker = WafW00F(hostname,port=port,ssl=ssl,
-                           debuglevel=options.verbose,path=path,
-                           followredirect=options.followredirect)
-        if attacker.normalrequest() is None:
-            log.error('Site %s appears to be down' % target)
-            sys.exit(1)
         if options.test:
+            attacker = newattacker(target,options.verbose,options.followredirect,
+                                   options.concurrency)
+            if attacker is None:
+                log.critical('The url %s is not well formed' % target)
+                sys.exit(1)
+            if attacker.normalrequest() is None:
+                log.error('Site %s appears to be down' % target)
+                sys.exit(1)
             if attacker.wafdetections.has_key(options.test):
                 waf = attacker.wafdetections[options.test](attacker)
                 if waf:
@@ -680,19 +851,23 @@ def main():
             else:
                 print "WAF %s was not found in our list\r\nUse the --list option to see what is available" % options.test
             return
-        waf = attacker.identwaf(options.findall)
-        log.info('Ident WAF: %s' % waf)
+        result = scantarget(target,options.findall,options.verbose,
+                            options.followredirect,options.concurrency)
+        if result['error']:
+            log.critical(result['error'])
+            sys.exit(1)
+        waf = result['wafname']
         if len(waf) > 0:
             print 'The site %s is behind a %s' % (target, ' and/or '.join( waf))
-        if (options.findall) or len(waf) == 0:
+        if result['generic'] is not None:
             print 'Generic Detection results:'          
-            if attacker.genericdetect():                
-                log.info('Generic Detection: %s' % attacker.knowledge['generic']['reason'])                    
+            if result['generic']['found']:
+                log.info('Generic Detection: %s' % result['generic']['reason'])                    
                 print 'The site %s seems to be behind a WAF ' % target
-                print 'Reason: %s' % attacker.knowledge['generic']['reason']
+                print 'Reason: %s' % result['generic']['reason']
             else:
                 print 'No WAF detected by the generic detection'
-        print 'Number of requests: %s' % attacker.requestnumber
+        print 'Number of requests: %s' % result['requests']
 
 if __name__ == '__main__':
     if sys.hexversion < 0x2040000:
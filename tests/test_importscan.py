@@ -0,0 +1,96 @@
+#!/usr/bin/env python2
+
+# tests for the importscan plugin: imports the sample scans in data/ into an
+# in-memory host database and checks the host and port rows.
+# Run from the top of the tree with:  python -m unittest discover tests
+
+import imp
+import os.path
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from bywaf import WAFterpreter
+from hostdb import HostDatabase
+
+PLUGIN_PATH = os.path.join(ROOT_DIR, 'plugins', 'external', 'importscan.py')
+
+
+# the parts of the WAFterpreter API that importscan uses
+class FakeApp:
+
+   def __init__(self):
+       self.hostdb = HostDatabase()
+
+   def cancel_token(self):
+       return None
+
+   get_option = WAFterpreter.__dict__['get_option']
+
+
+class ImportScanTest(unittest.TestCase):
+
+   def setUp(self):
+       self.app = FakeApp()
+       self.plugin = imp.load_source('importscan', PLUGIN_PATH)
+       self.plugin.app = self.app
+       self.plugin.plugin_path = PLUGIN_PATH
+
+   def tearDown(self):
+       self.app.hostdb.close()
+
+   def import_sample(self, filename, scan_format='auto'):
+       self.plugin.options['FORMAT'] = (scan_format,) + self.plugin.options['FORMAT'][1:]
+       return self.plugin.do_importscan(os.path.join(TESTS_DIR, 'data', filename))
+
+   def hosts(self):
+       return sorted((row.hostip, row.hostname) for row in self.app.hostdb.iter_table('Hosts'))
+
+   def ports(self, hostip):
+       return sorted((int(row.portnum), row.protocol, row.state)
+                     for row in self.app.hostdb.get_host_portinfo(hostip))
+
+   def service_names(self, hostip):
+       return dict((int(row.portnum), row.svcname) for row in self.app.hostdb.get_host_portinfo(hostip))
+
+   def test_xml(self):
+       summary = self.import_sample('scan.xml')
+       self.assertIn('(xml)', summary)
+       self.assertEqual(self.hosts(), [('192.0.2.10', 'www.example.com'), ('192.0.2.11', None)])
+       self.assertEqual(self.ports('192.0.2.10'), [(22, 'tcp', 'open'), (80, 'tcp', 'open'), (443, 'tcp', 'filtered')])
+       self.assertEqual(self.ports('192.0.2.11'), [(53, 'udp', 'open'), (8080, 'tcp', 'closed')])
+       self.assertEqual(self.service_names('192.0.2.10'), {22: 'ssh', 80: 'http', 443: 'https'})
+
+   def test_greppable(self):
+       summary = self.import_sample('scan.gnmap')
+       self.assertIn('(greppable)', summary)
+       # hosts that are down have no Ports: line and are not imported
+       self.assertEqual(self.hosts(), [('198.51.100.1', 'mail.example.org'), ('198.51.100.2', None)])
+       self.assertEqual(self.ports('198.51.100.1'), [(25, 'tcp', 'open'), (110, 'tcp', 'closed'), (143, 'tcp', 'filtered')])
+       self.assertEqual(self.ports('198.51.100.2'), [(53, 'udp', 'open')])
+       self.assertEqual(self.service_names('198.51.100.1'), {25: 'smtp', 110: 'pop3', 143: 'imap'})
+
+   def test_list(self):
+       summary = self.import_sample('scan.lst')
+       self.assertIn('(list)', summary)
+       self.assertEqual(self.hosts(), [('203.0.113.5', None), ('203.0.113.7', None)])
+       # masscan reports a port again when it sees it again; it is stored once
+       self.assertEqual(self.ports('203.0.113.5'), [(80, 'tcp', 'open'), (443, 'tcp', 'open')])
+       self.assertEqual(self.ports('203.0.113.7'), [(22, 'tcp', 'open')])
+
+   def test_explicit_format(self):
+       self.import_sample('scan.lst', 'list')
+       self.assertEqual(len(self.hosts()), 2)
+
+   def test_small_batches(self):
+       self.plugin.options['BATCH_ROWS'] = ('1',) + self.plugin.options['BATCH_ROWS'][1:]
+       self.import_sample('scan.xml')
+       self.assertEqual(len(self.hosts()), 2)
+       self.assertEqual(len(self.ports('192.0.2.10')), 3)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+
+# tests for the portscan plugin: scans listeners bound on the loopback
+# interface and checks the host and port rows it records.
+# Run from the top of the tree with:  python -m unittest discover tests
+
+import imp
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from bywaf import WAFterpreter
+from hostdb import HostDatabase, ServiceDefinitions
+
+PLUGIN_PATH = os.path.join(ROOT_DIR, 'plugins', 'external', 'portscan.py')
+
+
+# the parts of the WAFterpreter API that portscan uses
+class FakeApp:
+
+   def __init__(self, servicedefs):
+       self.hostdb = HostDatabase(servicedefs=servicedefs)
+
+   def cancel_token(self):
+       return None
+
+   get_option = WAFterpreter.__dict__['get_option']
+
+
+class PortScanTest(unittest.TestCase):
+
+   def setUp(self):
+       # a listening port, and a port nothing listens on
+       self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+       self.listener.bind(('127.0.0.1', 0))
+       self.listener.listen(16)
+       self.open_port = self.listener.getsockname()[1]
+       unused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+       unused.bind(('127.0.0.1', 0))
+       self.closed_port = unused.getsockname()[1]
+       unused.close()
+
+       # service definitions naming both ports
+       self.tempdir = tempfile.mkdtemp()
+       services = os.path.join(self.tempdir, 'services')
+       with open(services, 'w') as f:
+           f.write('bywaf-open\t{}/tcp\nbywaf-closed\t{}/tcp\n'.format(self.open_port, self.closed_port))
+
+       self.app = FakeApp(ServiceDefinitions(services))
+       self.plugin = imp.load_source('portscan', PLUGIN_PATH)
+       self.plugin.app = self.app
+       self.plugin.plugin_path = PLUGIN_PATH
+
+   def tearDown(self):
+       self.listener.close()
+       self.app.hostdb.close()
+       shutil.rmtree(self.tempdir)
+
+   def set_option(self, name, value):
+       self.plugin.options[name] = (value,) + self.plugin.options[name][1:]
+
+   def scan(self, targets, ports):
+       self.set_option('TARGET_HOST', targets)
+       self.set_option('PORTS', ','.join(str(port) for port in ports))
+       self.set_option('TIMEOUT', '5')
+       return self.plugin.do_portscan('')
+
+   def ports(self, hostip):
+       return sorted((row.portnum, row.protocol, row.state, row.svcname)
+                     for row in self.app.hostdb.get_host_portinfo(hostip))
+
+   # the number of connections the listener has had
+   def accepted(self):
+       self.listener.setblocking(0)
+       count = 0
+       try:
+           while True:
+               self.listener.accept()[0].close()
+               count += 1
+       except socket.error:
+           return count
+
+   def test_open_and_closed(self):
+       summary = self.scan('127.0.0.1', [self.open_port, self.closed_port])
+       self.assertIn('1 open, 1 closed, 0 filtered', summary)
+       self.assertEqual([(row.hostip, row.hostname) for row in self.app.hostdb.iter_table('Hosts')],
+                        [('127.0.0.1', None)])
+       self.assertEqual(self.ports('127.0.0.1'), sorted([(self.open_port, 'tcp', 'open', 'bywaf-open'),
+                                                         (self.closed_port, 'tcp', 'closed', 'bywaf-closed')]))
+       self.assertEqual(self.accepted(), 1)
+
+   def test_record_states(self):
+       self.set_option('RECORD_STATES', 'open')
+       self.scan('127.0.0.1', [self.open_port, self.closed_port])
+       self.assertEqual(self.ports('127.0.0.1'), [(self.open_port, 'tcp', 'open', 'bywaf-open')])
+
+   def test_address_and_name_of_one_host(self):
+       # both specs are the same address: it is connected to once, and the
+       # host row gets the name whichever spec comes first
+       for targets in ['127.0.0.1 localhost', 'localhost 127.0.0.1']:
+           summary = self.scan(targets, [self.open_port])
+           self.assertIn('1 ports scanned on 1 hosts', summary)
+           self.assertEqual([(row.hostip, row.hostname) for row in self.app.hostdb.iter_table('Hosts')],
+                            [('127.0.0.1', 'localhost')])
+           self.assertEqual(self.accepted(), 1)
+
+   def test_range(self):
+       summary = self.scan('127.0.0.1-2', [self.closed_port])
+       self.assertIn('2 ports scanned on 2 hosts', summary)
+
+   def test_lookups_do_not_block(self):
+       # while a lookup is pending, iter_endpoints yields None instead of waiting
+       release = threading.Event()
+       gethostbyname = socket.gethostbyname
+       def slow_gethostbyname(host):
+           release.wait(5)
+           return gethostbyname(host)
+       socket.gethostbyname = slow_gethostbyname
+       try:
+           endpoints = self.plugin.iter_endpoints(['localhost', '127.0.0.2'], [80])
+           self.assertEqual(next(endpoints), ('127.0.0.2', None, 80))
+           self.assertEqual(next(endpoints), None)
+           release.set()
+           self.assertEqual([e for e in endpoints if e is not None], [('127.0.0.1', 'localhost', 80)])
+       finally:
+           socket.gethostbyname = gethostbyname
+
+
+if __name__ == '__main__':
+   unittest.main()